@@ -0,0 +1,133 @@
+import asyncio
+import time
+
+import logs
+
+# 掲示板の更新をまとめて配るハブ
+# (verify, channel)ごとに1つだけ掲示板サーバーを定期的に見に行くタスクを動かし、内容が変わったら
+# 待っている全員(SSE・ロングポーリング・/bbs/api)に同じものを渡す。読者が何人いても上流へのリクエストは一定。
+# 誰も見なくなってidle秒たったらタスクは止まり、ハブからも消える。
+# 誰でも好きなチャンネル名で取得タスクを増やせないよう、動かすのはchannelsにあるチャンネルだけ。
+
+
+class Feed:
+    def __init__(self, fetch, interval, idle, on_stop=None):
+        self.fetch = fetch
+        self.interval = interval
+        self.idle = idle
+        self.on_stop = on_stop
+        self.version = 0
+        self.body = None
+        self.updated = 0.0
+        self.polls = 0
+        self._changed = asyncio.Event()
+        self._subscribers = 0
+        self._last_seen = time.time()
+        self._task = None
+
+    def _touch(self):
+        self._last_seen = time.time()
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+
+    def _wanted(self):
+        return self._subscribers > 0 or time.time() - self._last_seen < self.idle
+
+    async def _run(self):
+        failures = 0
+        try:
+            while self._wanted():
+                self.polls += 1
+                try:
+                    body = await self.fetch()
+                except Exception as e:
+                    # 掲示板サーバーが落ちている間は間隔を広げる
+                    failures += 1
+                    logs.warning("掲示板の取得に失敗しました", error=type(e).__name__)
+                    await asyncio.sleep(min(self.interval * 2 ** failures, 30))
+                    continue
+                failures = 0
+                if body != self.body:
+                    self.body = body
+                    self.version += 1
+                    self.updated = time.time()
+                    changed, self._changed = self._changed, asyncio.Event()
+                    changed.set()
+                await asyncio.sleep(self.interval)
+        finally:
+            self._task = None
+            if self.on_stop is not None:
+                self.on_stop(self)
+
+    async def wait(self, since, timeout):
+        """versionがsinceより新しくなるまで最大timeout秒待つ。新しくなればTrue。"""
+        self._touch()
+        deadline = time.time() + timeout
+        while self.version <= since:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            try:
+                await asyncio.wait_for(self._changed.wait(), remaining)
+            except asyncio.TimeoutError:
+                return False
+        return True
+
+    async def latest(self, timeout):
+        """今の内容。まだ一度も取れていなければ最初の取得を待つ。"""
+        if self.version == 0:
+            await self.wait(0, timeout)
+        else:
+            self._touch()
+        return self.body
+
+    async def stream(self, since, heartbeat):
+        """更新のたびに(version, body)を、heartbeat秒何もなければNoneを返し続ける。"""
+        self._subscribers += 1
+        try:
+            while True:
+                if await self.wait(since, heartbeat):
+                    since = self.version
+                    yield self.version, self.body
+                else:
+                    yield None
+        finally:
+            self._subscribers -= 1
+            self._last_seen = time.time()
+
+
+class FeedHub:
+    def __init__(self, fetch, interval=1.0, idle=60, max_feeds=256, channels=None):
+        self.fetch = fetch  # fetch(verify, channel) -> 本文
+        self.interval = interval
+        self.idle = idle
+        self.max_feeds = max_feeds
+        self.channels = None if channels is None else frozenset(channels)  # Noneなら制限しない
+        self._feeds = {}
+        self._retired_polls = 0
+
+    def feed(self, verify, channel):
+        """(verify, channel)のFeed。channelsに無いチャンネルならKeyError、多すぎればOverflowError。"""
+        key = (verify, channel)
+        feed = self._feeds.get(key)
+        if feed is None:
+            if self.channels is not None and channel not in self.channels:
+                raise KeyError(channel)
+            if len(self._feeds) >= self.max_feeds:
+                raise OverflowError("too many bbs feeds")
+            feed = self._feeds[key] = Feed(lambda: self.fetch(verify, channel), self.interval, self.idle, on_stop=lambda f: self._drop(key, f))
+        return feed
+
+    def _drop(self, key, feed):
+        if self._feeds.get(key) is feed and not feed._wanted():
+            del self._feeds[key]
+            self._retired_polls += feed.polls
+
+    def close(self):
+        for feed in list(self._feeds.values()):
+            if feed._task is not None:
+                feed._task.cancel()
+
+    def stats(self):
+        feeds = list(self._feeds.values())
+        return {"feeds": len(feeds), "subscribers": sum(f._subscribers for f in feeds), "polls": self._retired_polls + sum(f.polls for f in feeds)}
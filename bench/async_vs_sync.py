@@ -0,0 +1,86 @@
+"""同期版(スレッドプール)と非同期版のリクエスト層が同時にさばける数を比べるベンチマーク。
+
+    python bench/async_vs_sync.py --latency 0.5 --concurrency 50 200 1000
+
+同期版は以前のapirequestと同じく、インスタンスを順にブロッキングI/Oで試す関数を
+FastAPIの同期ルートと同じ既定40スレッドのプールで呼ぶ(アプリからは消えたのでここに持っている)。
+非同期版は1つのイベントループでapirequest_asyncをまとめて待つ。
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCH_DIR)
+sys.path[:0] = [BENCH_DIR, ROOT]
+os.chdir(ROOT)
+os.environ.setdefault("YUKI_SHARED_DB", "")  # 動いているサーバーの共有DBとは混ぜない
+
+from fake_upstream import FakeUpstream  # noqa: E402
+
+import main  # noqa: E402
+
+
+def sync_apirequest(instances, url):
+    # 以前の同期版: 1つずつ順に試し、200でJSONとして読めたものを返す
+    for api in instances:
+        try:
+            with urllib.request.urlopen(api + url, timeout=main.max_api_wait_time) as res:
+                return json.loads(res.read())
+        except (OSError, ValueError):
+            continue
+    raise main.APItimeoutError("APIがタイムアウトしました")
+
+
+def run_sync(n, threads):
+    instances = main.health.instances
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        list(pool.map(lambda i: sync_apirequest(instances, f"api/v1/search?q=sync{i}"), range(n)))
+    return time.time() - start
+
+
+def run_async(n):
+    async def go():
+        await asyncio.gather(*[main.apirequest_async(f"api/v1/search?q=async{i}") for i in range(n)])
+        await main.upstream.aclose()
+
+    start = time.time()
+    asyncio.run(go())
+    return time.time() - start
+
+
+def bench():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--latency", type=float, default=0.5, help="偽サーバーの応答時間(秒)")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[50, 200, 1000])
+    parser.add_argument("--threads", type=int, default=40, help="同期版のスレッド数(anyioの既定値は40)")
+    parser.add_argument("--out", help="結果をJSONで書き出すファイル")
+    args = parser.parse_args()
+
+    fake = FakeUpstream(latency=args.latency)
+    main.health.set_instances([fake.start()])
+    main.hedge_width = 0  # 1リクエスト=上流1回にして比べる
+
+    results = []
+    print(f"{'mode':<6}{'n':>6}{'seconds':>10}{'req/s':>10}{'in-flight':>11}")
+    for n in args.concurrency:
+        for mode in ("sync", "async"):
+            seconds = run_sync(n, args.threads) if mode == "sync" else run_async(n)
+            # 平均して同時に上流を待っていた数
+            inflight = n * args.latency / seconds
+            results.append({"mode": mode, "n": n, "seconds": round(seconds, 3), "rps": round(n / seconds, 1), "inflight": round(inflight, 1)})
+            print(f"{mode:<6}{n:>6}{seconds:>10.2f}{n / seconds:>10.1f}{inflight:>11.1f}")
+    fake.stop()
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump({"latency": args.latency, "threads": args.threads, "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    bench()
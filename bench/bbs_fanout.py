@@ -0,0 +1,111 @@
+"""掲示板の更新をSSEで配ったときの、上流への負荷と届くまでの時間を測る。
+
+    python bench/bbs_fanout.py --clients 10 100 500 --messages 10
+
+ローカルの偽掲示板(fake_bbs)とアプリ(uvicorn)を立て、clients個のSSE接続をつないでから
+messages件を書き込む。書き込みから各クライアントに届くまでの時間と、その間に上流へ行った
+リクエスト数を出す。上流へのリクエスト数はクライアント数によらず一定になるはず。
+"""
+import argparse
+import asyncio
+import json
+import os
+import re
+import statistics
+import sys
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCH_DIR)
+sys.path[:0] = [BENCH_DIR, ROOT]
+os.chdir(ROOT)
+os.environ.setdefault("YUKI_API_LIST_REFRESH", "0")
+os.environ.setdefault("YUKI_SHARED_DB", "")  # 動いているサーバーの共有DBとは混ぜない
+
+import aiohttp  # noqa: E402
+import uvicorn  # noqa: E402
+
+from fake_bbs import FakeBBS  # noqa: E402
+
+import main  # noqa: E402
+
+
+async def client(session, base, channel, seen, ready):
+    # 届いた書き込みごとに、書き込まれた時刻からの遅れを記録する
+    async with session.get(f"{base}bbs/stream?channel={channel}", timeout=aiohttp.ClientTimeout(total=None)) as res:
+        ready.set()
+        async for line in res.content:
+            for posted in re.findall(rb'data-posted="([\d.]+)"', line):
+                if posted not in seen:
+                    seen[posted] = time.time() - float(posted)
+
+
+async def run(base, fake, n, messages, interval):
+    channel = f"bench{n}"
+    seen = [{} for _ in range(n)]
+    readies = [asyncio.Event() for _ in range(n)]
+    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=0)) as session:
+        tasks = [asyncio.ensure_future(client(session, base, channel, seen[i], readies[i])) for i in range(n)]
+        await asyncio.wait_for(asyncio.gather(*[r.wait() for r in readies]), 30)
+        before = fake.polls.get(channel, 0)
+        start = time.time()
+        for i in range(messages):
+            fake.post(f"message {i}", channel)
+            await asyncio.sleep(interval)
+        await asyncio.sleep(main.bbs_feeds.interval * 2)
+        seconds = time.time() - start
+        upstream_requests = fake.polls.get(channel, 0) - before
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+    delays = sorted(d for s in seen for d in s.values())
+    delivered = len(delays) / (n * messages)
+    return {
+        "clients": n, "messages": messages, "delivered": round(delivered, 3),
+        "p50": round(statistics.median(delays), 3) if delays else None,
+        "p95": round(delays[int(len(delays) * 0.95) - 1], 3) if delays else None,
+        "upstream_requests": upstream_requests, "upstream_rps": round(upstream_requests / seconds, 2),
+    }
+
+
+async def bench_async(args, fake):
+    main.bbs_feeds.interval = args.interval
+    main.bbs_feeds.channels = None  # 測るたびに別のチャンネルを使うので、どれでも取得タスクを動かす
+    server = uvicorn.Server(uvicorn.Config(main.app, host="127.0.0.1", port=args.port, log_level="warning", lifespan="on"))
+    serving = asyncio.ensure_future(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.05)
+    base = f"http://127.0.0.1:{args.port}/"
+    results = []
+    print(f"{'clients':>8}{'delivered':>11}{'p50(s)':>9}{'p95(s)':>9}{'upstream':>10}{'up req/s':>10}")
+    for n in args.clients:
+        r = await run(base, fake, n, args.messages, args.message_interval)
+        results.append(r)
+        print(f"{r['clients']:>8}{r['delivered']:>11}{r['p50']:>9}{r['p95']:>9}{r['upstream_requests']:>10}{r['upstream_rps']:>10}")
+    server.should_exit = True
+    await serving
+    return results
+
+
+def bench():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--clients", type=int, nargs="+", default=[10, 100, 500])
+    parser.add_argument("--messages", type=int, default=10)
+    parser.add_argument("--message-interval", type=float, default=0.5, help="書き込みの間隔(秒)")
+    parser.add_argument("--interval", type=float, default=1.0, help="掲示板サーバーを見に行く間隔(秒)")
+    parser.add_argument("--latency", type=float, default=0.05, help="偽掲示板の応答時間(秒)")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--out", help="結果をJSONで書き出すファイル")
+    args = parser.parse_args()
+    # 偽掲示板は別スレッドのループで動かす
+    fake = FakeBBS(latency=args.latency)
+    main.set_bbs_url(fake.start())
+    results = asyncio.run(bench_async(args, fake))
+    fake.stop()
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump({"interval": args.interval, "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    bench()
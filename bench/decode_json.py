@@ -0,0 +1,61 @@
+"""動画APIの応答の読み込みにかかる時間を、以前の方法とrecordsで比べるマイクロベンチマーク。
+
+    python bench/decode_json.py --related 20 --formats 40 --number 2000
+
+old:      is_jsonで1回、呼び出し側でもう1回json.loadsし、テンプレート用にjson.dumpsし直す
+records:  records.video(bytes)で1回だけ解析し、必要な項目をレコードに写す
+json/orjsonが両方使えるときはバックエンドごとに測る。
+"""
+import argparse
+import json
+import os
+import sys
+import timeit
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCH_DIR)
+sys.path[:0] = [BENCH_DIR, ROOT]
+
+import records  # noqa: E402
+from fixtures import video_payload  # noqa: E402
+
+
+def old_path(text):
+    # 以前のis_json + json.loads + json.dumps(t)
+    json.loads(text)
+    t = json.loads(text)
+    related = [{"id": i["videoId"], "title": i["title"], "authorId": i["authorId"], "author": i["author"], "viewCount": i["viewCount"]} for i in t["recommendedVideos"]]
+    return json.dumps(t), related, list(reversed([i["url"] for i in t["formatStreams"]]))[:2], t["descriptionHtml"].replace("\n", "<br>")
+
+
+def bench():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--related", type=int, default=20)
+    parser.add_argument("--formats", type=int, default=40)
+    parser.add_argument("--number", type=int, default=2000)
+    parser.add_argument("--out", help="結果をJSONで書き出すファイル")
+    args = parser.parse_args()
+
+    text = json.dumps(video_payload(args.related, args.formats), ensure_ascii=False)
+    data = text.encode("utf-8")
+    orjson = records.orjson
+    # (名前, 関数, recordsに使わせるorjson)
+    cases = [("old (json x2 + dumps)", lambda: old_path(text), None), ("records (json)", lambda: records.video(data), None)]
+    if orjson is not None:
+        cases.append(("records (orjson)", lambda: records.video(data), orjson))
+
+    print(f"payload {len(data) / 1024:.1f} KiB, {args.number} runs")
+    results = []
+    for name, f, backend in cases:
+        records.orjson = backend
+        seconds = min(timeit.repeat(f, number=args.number, repeat=3)) / args.number
+        results.append({"case": name, "microseconds": round(seconds * 1e6, 1)})
+        print(f"{name:<24}{seconds * 1e6:>10.1f} us/op")
+    records.orjson = orjson
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump({"payload_bytes": len(data), "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    bench()
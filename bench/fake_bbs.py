@@ -0,0 +1,28 @@
+import html
+import time
+import urllib.parse
+
+from fake_upstream import FakeUpstream
+
+# ベンチマーク・動作確認用のローカルな掲示板サーバーの代わり
+# /bbs/apiはチャンネルごとの書き込みをHTMLの断片で返す。post()で書き込みを足せる。
+
+
+class FakeBBS(FakeUpstream):
+    def __init__(self, latency=0.05, **kwargs):
+        super().__init__(latency=latency, **kwargs)
+        self.messages = {}
+        self.polls = {}  # チャンネルごとの/bbs/apiへのリクエスト数
+
+    def post(self, message, channel="main"):
+        self.messages.setdefault(channel, []).append((time.time(), message))
+
+    def respond(self, path, headers=None):
+        parts = urllib.parse.urlsplit(path)
+        query = urllib.parse.parse_qs(parts.query)
+        if parts.path != "/bbs/api":
+            return 404, b"not found", "text/plain"
+        channel = query.get("channel", ["main"])[0]
+        self.polls[channel] = self.polls.get(channel, 0) + 1
+        rows = [f'<tr><td data-posted="{posted:.6f}">{html.escape(message)}</td></tr>' for posted, message in reversed(self.messages.get(channel, []))]
+        return 200, ("<table>\n" + "\n".join(rows) + "\n</table>").encode(), "text/html; charset=utf-8"
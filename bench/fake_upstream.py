@@ -0,0 +1,162 @@
+"""ベンチマーク用のローカルな偽Invidiousサーバー。
+
+外部のミラーに依存せずに、決まったレイテンシでJSONを返す。インスタンスごとに
+レイテンシ・ばらつき・エラー率を変えられ、サムネイル(/vi/{v}/0.jpg)と
+Range対応の動画本体(/media/{name})も返す。/__statsでリクエスト数が見られる。
+
+別プロセスで立てるときは「レイテンシ:エラー率」をインスタンスの数だけ渡す。
+
+    python bench/fake_upstream.py --instance 0.05:0 --instance 0.3:0.2 --size 20
+
+起動したインスタンスのurlをJSONで1行出力し、止められるまで動き続ける。
+"""
+import argparse
+import asyncio
+import hashlib
+import http
+import json
+import random
+import re
+import threading
+import urllib.parse
+
+from fixtures import Fixtures, blob
+
+
+def default_payload(path):
+    return {"path": path, "latestVideos": [], "comments": [], "videos": []}
+
+
+class FakeUpstream:
+    def __init__(self, latency=0.5, payload=default_payload, host="127.0.0.1", port=0, error_rate=0.0, jitter=0.0,
+                 thumbnail_bytes=16 * 1024, media_bytes=8 * 1024 * 1024):
+        self.latency = latency
+        self.payload = payload
+        self.host = host
+        self.port = port
+        self.error_rate = error_rate  # この割合のリクエストに500を返す
+        self.jitter = jitter  # レイテンシに足す0〜jitter秒のばらつき
+        self.thumbnail_bytes = thumbnail_bytes
+        self.media_bytes = media_bytes
+        self.requests = 0
+        self.errors = 0
+        self._media = {}
+        self._loop = None
+        self._server = None
+        self._writers = set()
+
+    @property
+    def url(self):
+        return f"http://{self.host}:{self.port}/"
+
+    def stats(self):
+        return {"url": self.url, "requests": self.requests, "errors": self.errors}
+
+    def _media_body(self, name):
+        body = self._media.get(name)
+        if body is None:
+            body = self._media[name] = blob(name, self.media_bytes)
+        return body
+
+    def respond(self, path, headers=None):
+        """(ステータス, ボディ, Content-Type) か、それに追加のヘッダーを足した4つ組を返す。"""
+        headers = headers or {}
+        parts = urllib.parse.urlsplit(path)
+        if parts.path.startswith("/vi/"):
+            body = blob(parts.path, self.thumbnail_bytes)
+            etag = '"' + hashlib.sha1(body).hexdigest() + '"'
+            if headers.get("if-none-match") == etag:
+                return 304, b"", "image/jpeg", {"ETag": etag}
+            return 200, body, "image/jpeg", {"ETag": etag, "Last-Modified": "Mon, 01 Jan 2024 00:00:00 GMT"}
+        if parts.path.startswith("/media/"):
+            body = self._media_body(parts.path)
+            m = re.fullmatch(r"bytes=(\d+)-(\d*)", headers.get("range", ""))
+            if m is None:
+                return 200, body, "video/mp4", {"Accept-Ranges": "bytes"}
+            start = int(m.group(1))
+            end = min(int(m.group(2)) if m.group(2) else len(body) - 1, len(body) - 1)
+            if start > end:
+                return 416, b"", "video/mp4", {"Content-Range": f"bytes */{len(body)}"}
+            return 206, body[start:end + 1], "video/mp4", {"Accept-Ranges": "bytes", "Content-Range": f"bytes {start}-{end}/{len(body)}"}
+        return 200, json.dumps(self.payload(path), ensure_ascii=False).encode(), "application/json"
+
+    async def _handle(self, reader, writer):
+        self._writers.add(writer)
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                path = line.split()[1].decode()
+                headers = {}
+                while (header := await reader.readline()) not in (b"\r\n", b""):
+                    name, _, value = header.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                if path == "/__stats":
+                    response = (200, json.dumps(self.stats()).encode(), "application/json")
+                else:
+                    self.requests += 1
+                    delay = self.latency + (random.uniform(0, self.jitter) if self.jitter else 0)
+                    if delay:
+                        await asyncio.sleep(delay)
+                    if self.error_rate and random.random() < self.error_rate:
+                        self.errors += 1
+                        response = (500, b"fake error", "text/plain")
+                    else:
+                        response = self.respond(path, headers)
+                status, body, content_type = response[:3]
+                extra = "".join(f"{k}: {v}\r\n" for k, v in (response[3] if len(response) > 3 else {}).items())
+                writer.write(f"HTTP/1.1 {status} {http.HTTPStatus(status).phrase}\r\nContent-Type: {content_type}\r\nContent-Length: {len(body)}\r\n{extra}\r\n".encode() + body)
+                await writer.drain()
+        except (ConnectionError, IndexError):
+            pass
+        finally:
+            self._writers.discard(writer)
+            writer.close()
+
+    def start(self):
+        """別スレッドのイベントループで起動してURLを返す。"""
+        self._loop = asyncio.new_event_loop()
+        self._server = self._loop.run_until_complete(asyncio.start_server(self._handle, self.host, self.port, backlog=4096))
+        self.port = self._server.sockets[0].getsockname()[1]
+        threading.Thread(target=self._loop.run_forever, daemon=True).start()
+        return self.url
+
+    async def _shutdown(self):
+        self._server.close()
+        for writer in list(self._writers):
+            writer.close()
+        tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        if tasks:
+            await asyncio.wait(tasks, timeout=self.latency + self.jitter + 1)
+
+    def stop(self):
+        if self._loop is not None:
+            asyncio.run_coroutine_threadsafe(self._shutdown(), self._loop).result(timeout=5)
+            self._loop.call_soon_threadsafe(self._loop.stop)
+
+
+def serve():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--instance", action="append", default=[], help="レイテンシ(秒):エラー率。インスタンスごとに繰り返す")
+    parser.add_argument("--jitter", type=float, default=0.0, help="レイテンシに足すばらつき(秒)")
+    parser.add_argument("--size", type=int, default=20, help="一覧の件数")
+    parser.add_argument("--fixtures", help="fixtures.pyで記録した応答のディレクトリ")
+    parser.add_argument("--media-bytes", type=int, default=8 * 1024 * 1024)
+    args = parser.parse_args()
+    fixtures = Fixtures(args.fixtures, args.size)
+    fakes = []
+    for spec in args.instance or ["0.05:0"]:
+        latency, _, error_rate = spec.partition(":")
+        fake = FakeUpstream(latency=float(latency), payload=fixtures.payload, error_rate=float(error_rate or 0), jitter=args.jitter, media_bytes=args.media_bytes)
+        fake.start()
+        fakes.append(fake)
+    print(json.dumps({"urls": [fake.url for fake in fakes]}), flush=True)
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    serve()
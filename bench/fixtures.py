@@ -0,0 +1,187 @@
+"""ベンチマーク用の上流の応答。
+
+偽Invidious(fake_upstream)が返す/api/v1/videos・search・channels・comments・playlistsの応答と、
+サムネイル・動画本体のバイト列を作る。sizeで一覧の件数(=応答の大きさ)を変えられる。
+
+本物のインスタンスから取った応答を使いたいときは先に記録しておく。
+
+    python bench/fixtures.py --instance https://inv.example.com/ --out bench/recorded
+
+記録したディレクトリをFixtures(directory)に渡すと、その種類は記録した応答を返す
+(件数はsizeに合わせて増減させる)。無い種類は作った応答を返す。
+"""
+import argparse
+import hashlib
+import json
+import os
+import urllib.parse
+import urllib.request
+
+KINDS = ("videos", "search", "channels", "comments", "playlists")
+
+
+def video_payload(related=20, formats=40, description=4000, video_id="dQw4w9WgXcQ"):
+    """Invidiousの/api/v1/videosに似せた応答。"""
+    def stream(i):
+        return {
+            "url": f"https://rr1---sn-example.googlevideo.com/videoplayback?expire=1900000000&id=o-abc{i}&itag={18 + i}&clen={1000000 * i}&sig=" + "x" * 200,
+            "itag": str(18 + i), "type": "video/mp4; codecs=\"avc1.42001E, mp4a.40.2\"", "quality": "medium",
+            "bitrate": str(500000 + i), "init": "0-740", "index": "741-1200", "lmt": "1700000000000000", "projectionType": "RECTANGULAR",
+        }
+    return {
+        "type": "video", "title": "ベンチマーク用の動画", "videoId": video_id,
+        "videoThumbnails": [{"quality": q, "url": f"https://i.ytimg.com/vi/{video_id}/{q}.jpg", "width": 480, "height": 360} for q in ("maxres", "sddefault", "high", "medium", "default", "start", "middle", "end")],
+        "description": "説明" * (description // 2), "descriptionHtml": "説明\n" * (description // 3),
+        "published": 1700000000, "publishedText": "1 year ago", "keywords": ["bench"] * 30, "viewCount": 123456789, "likeCount": 1234567,
+        "author": "チャンネル", "authorId": "UCxxxxxxxxxxxxxxxxxxxxxx", "authorUrl": "/channel/UCxxxxxxxxxxxxxxxxxxxxxx",
+        "authorThumbnails": [{"url": f"https://yt3.ggpht.com/a/{size}", "width": size, "height": size} for size in (32, 48, 76, 100, 176, 512)],
+        "lengthSeconds": 212, "allowRatings": True, "isFamilyFriendly": True, "genre": "Music",
+        "adaptiveFormats": [stream(i) for i in range(formats)],
+        "formatStreams": [stream(i) for i in range(2)],
+        "captions": [{"label": "日本語", "language_code": "ja", "url": f"/api/v1/captions/{video_id}?label=ja"}],
+        "recommendedVideos": [{
+            "videoId": f"rel{i:08d}", "title": f"関連動画 {i}", "author": "関連チャンネル", "authorId": "UCyyyyyyyyyyyyyyyyyyyyyy",
+            "videoThumbnails": [{"quality": q, "url": f"https://i.ytimg.com/vi/rel{i:08d}/{q}.jpg"} for q in ("high", "medium", "default")],
+            "lengthSeconds": 300, "viewCountText": "1M views", "viewCount": 1000000 + i,
+        } for i in range(related)],
+    }
+
+
+def _author_thumbnails():
+    return [{"url": f"https://yt3.ggpht.com/a/{size}", "width": size, "height": size} for size in (32, 48, 76, 100, 176, 512)]
+
+
+def _video_item(i, prefix="vid"):
+    return {
+        "type": "video", "title": f"検索結果の動画 {i}", "videoId": f"{prefix}{i:08d}", "author": "チャンネル", "authorId": "UCxxxxxxxxxxxxxxxxxxxxxx",
+        "videoThumbnails": [{"quality": q, "url": f"https://i.ytimg.com/vi/{prefix}{i:08d}/{q}.jpg"} for q in ("high", "medium", "default")],
+        "description": "説明" * 40, "viewCount": 1000 * i, "published": 1700000000, "publishedText": f"{i} days ago", "lengthSeconds": 60 + i,
+    }
+
+
+def search_payload(size=20):
+    """/api/v1/searchの応答。動画に混ぜてチャンネルと再生リストも返す。"""
+    items = []
+    for i in range(size):
+        if i % 10 == 3:
+            items.append({"type": "channel", "author": f"チャンネル {i}", "authorId": f"UCch{i:020d}", "authorThumbnails": _author_thumbnails(), "subCount": 1000, "videoCount": 100, "description": "説明"})
+        elif i % 10 == 7:
+            items.append({"type": "playlist", "title": f"再生リスト {i}", "playlistId": f"PL{i:032d}", "author": "チャンネル", "authorId": "UCxxxxxxxxxxxxxxxxxxxxxx", "videoCount": 10, "videos": [{"title": "最初の動画", "videoId": f"pl{i:09d}", "lengthSeconds": 100}]})
+        else:
+            items.append(_video_item(i))
+    return items
+
+
+def channel_payload(size=30, channel_id="UCxxxxxxxxxxxxxxxxxxxxxx"):
+    """/api/v1/channels/{id}の応答。"""
+    return {
+        "author": "チャンネル", "authorId": channel_id, "authorUrl": f"/channel/{channel_id}", "authorThumbnails": _author_thumbnails(),
+        "authorBanners": [{"url": "https://yt3.ggpht.com/banner", "width": 2560, "height": 424}], "subCount": 123456, "totalViews": 12345678,
+        "description": "チャンネルの説明" * 20, "descriptionHtml": "チャンネルの説明\n" * 20,
+        "latestVideos": [_video_item(i, "lat") for i in range(size)],
+    }
+
+
+def comments_payload(size=20, video_id="dQw4w9WgXcQ"):
+    """/api/v1/comments/{id}の応答。"""
+    return {
+        "commentCount": size * 10, "videoId": video_id, "continuation": "x" * 100,
+        "comments": [{
+            "author": f"ユーザー {i}", "authorThumbnails": _author_thumbnails(), "authorId": f"UCus{i:020d}", "authorUrl": f"/channel/UCus{i:020d}",
+            "content": "コメント\n" * 5, "contentHtml": "コメント\n" * 5, "published": 1700000000, "publishedText": "1 day ago", "likeCount": i, "commentId": f"c{i}",
+            "replies": {"replyCount": 1, "continuation": "y" * 60},
+        } for i in range(size)],
+    }
+
+
+def playlist_payload(size=50, playlist_id="PL0"):
+    """/api/v1/playlists/{id}の応答。"""
+    return {
+        "type": "playlist", "title": "再生リスト", "playlistId": playlist_id, "author": "チャンネル", "authorId": "UCxxxxxxxxxxxxxxxxxxxxxx",
+        "description": "説明", "videoCount": size, "viewCount": 1000,
+        "videos": [{"title": f"再生リストの動画 {i}", "videoId": f"pls{i:08d}", "author": "チャンネル", "authorId": "UCxxxxxxxxxxxxxxxxxxxxxx",
+                    "videoThumbnails": [{"quality": "medium", "url": f"https://i.ytimg.com/vi/pls{i:08d}/mqdefault.jpg"}], "index": i, "lengthSeconds": 200} for i in range(size)],
+    }
+
+
+def blob(name, size):
+    """nameから決まる、sizeバイトのバイト列(サムネイル・動画本体の代わり)。"""
+    seed = hashlib.sha256(name.encode()).digest()
+    return (seed * (size // len(seed) + 1))[:size]
+
+
+def kind_of(path):
+    """上流へのパスから応答の種類を返す。APIでなければNone。"""
+    for kind in KINDS:
+        if f"/api/v1/{kind}" in path:
+            return kind
+    return None
+
+
+def _resize(payload, kind, size):
+    # 記録した応答の一覧をsize件に揃える
+    key = {"videos": "recommendedVideos", "channels": "latestVideos", "comments": "comments", "playlists": "videos"}.get(kind)
+    items = payload if kind == "search" else payload.get(key)
+    if not items:
+        return payload
+    items = (items * (size // len(items) + 1))[:size]
+    if kind == "search":
+        return items
+    return {**payload, key: items}
+
+
+class Fixtures:
+    def __init__(self, directory=None, size=20):
+        self.size = size
+        self.recorded = {}
+        if directory:
+            for kind in KINDS:
+                path = os.path.join(directory, f"{kind}.json")
+                if os.path.exists(path):
+                    with open(path, "r", encoding="utf-8") as f:
+                        self.recorded[kind] = json.load(f)
+
+    def payload(self, path):
+        """/api/v1/...へのパスに対する応答(JSONにできるもの)。"""
+        kind = kind_of(path)
+        if kind in self.recorded:
+            return _resize(self.recorded[kind], kind, self.size)
+        name = urllib.parse.urlsplit(path).path.rstrip("/").rsplit("/", 1)[-1]
+        if kind == "videos":
+            return video_payload(related=self.size, video_id=name)
+        if kind == "search":
+            return search_payload(self.size)
+        if kind == "channels":
+            return channel_payload(self.size, name)
+        if kind == "comments":
+            return comments_payload(self.size, name)
+        if kind == "playlists":
+            return playlist_payload(self.size, name)
+        return {"error": "unknown path"}
+
+
+def record():
+    parser = argparse.ArgumentParser(description="本物のインスタンスから応答を記録する")
+    parser.add_argument("--instance", required=True, help="Invidiousインスタンスのurl")
+    parser.add_argument("--out", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "recorded"))
+    parser.add_argument("--video", default="dQw4w9WgXcQ")
+    parser.add_argument("--query", default="music")
+    parser.add_argument("--channel", default="UCuAXFkgsw1L7xaCfnd5JJOw")
+    parser.add_argument("--playlist", default="PLFgquLnL59alCl_2TQvOiD5Vgm1hCaGSI")
+    args = parser.parse_args()
+    base = args.instance.rstrip("/")
+    paths = {
+        "videos": f"/api/v1/videos/{args.video}", "search": f"/api/v1/search?q={urllib.parse.quote(args.query)}&hl=jp",
+        "channels": f"/api/v1/channels/{args.channel}", "comments": f"/api/v1/comments/{args.video}?hl=jp", "playlists": f"/api/v1/playlists/{args.playlist}",
+    }
+    os.makedirs(args.out, exist_ok=True)
+    for kind, path in paths.items():
+        with urllib.request.urlopen(base + path, timeout=30) as res:
+            payload = json.loads(res.read())
+        with open(os.path.join(args.out, f"{kind}.json"), "w", encoding="utf-8") as f:
+            json.dump(payload, f, ensure_ascii=False)
+        print(kind, path)
+
+
+if __name__ == "__main__":
+    record()
@@ -0,0 +1,198 @@
+"""アプリ全体の負荷試験。
+
+    python bench/load.py --duration 10 --concurrency 20 --instance 0.05:0 --instance 0.3:0.1 --out load.json
+
+偽Invidious(fake_upstream)とアプリ(uvicorn、--workersでワーカー数)をそれぞれ別プロセスで立て、
+ルートごとにconcurrency本の接続からduration秒リクエストを投げ続けて、p50/p95/p99とスループットを出す。
+測る前にwarmup秒だけ同じように投げて捨てる。--routesで測るルートを選べる
+(watch search channel comments thumbnail umekomi)。動画ID・検索語などは--keys個の中から選ぶので、
+小さくするほどキャッシュに当たる。上流へのリクエスト数も数えるので、キャッシュやヘッジの効き方も分かる。
+--outのJSONには測った条件(引数・コミット・Pythonのバージョン)も入れるので、後から比べられる。
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.parse
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCH_DIR)
+sys.path[:0] = [BENCH_DIR, ROOT]
+
+import aiohttp  # noqa: E402
+
+from shared_state import SharedState  # noqa: E402
+
+ROUTES = ("watch", "search", "channel", "comments", "thumbnail", "umekomi")
+
+
+def percentile(values, q):
+    """ソート済みのvaluesのq(0〜1)分位点。"""
+    if not values:
+        return None
+    return values[min(len(values) - 1, max(0, int(len(values) * q + 0.5) - 1))]
+
+
+def request_for(route, key, args, upstream_url):
+    """(パス, ヘッダー)を返す。"""
+    video_id = f"vid{key:08d}"
+    if route == "watch":
+        return f"/watch?v={video_id}", {}
+    if route == "search":
+        return f"/search?q=bench{key}&page=1", {}
+    if route == "channel":
+        return f"/channel/UCbench{key:017d}", {}
+    if route == "comments":
+        return f"/comments?v={video_id}", {}
+    if route == "thumbnail":
+        return f"/thumbnail?v={video_id}", {}
+    # シークしたときのように、動画のどこかからrange_bytesだけ読む
+    start = random.randrange(0, max(1, args.media_bytes - args.range_bytes))
+    url = urllib.parse.quote(f"{upstream_url}media/m{key}", safe="")
+    return f"/umekomi?url={url}", {"Range": f"bytes={start}-{start + args.range_bytes - 1}"}
+
+
+async def upstream_requests(session, urls):
+    total = 0
+    for url in urls:
+        async with session.get(f"{url}__stats") as res:
+            total += (await res.json())["requests"]
+    return total
+
+
+async def hammer(session, base, route, args, upstream_url, seconds, samples):
+    # 1本の接続で、次々にリクエストを投げる
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        path, headers = request_for(route, random.randrange(args.keys), args, upstream_url)
+        start = time.perf_counter()
+        try:
+            async with session.get(base + path, headers=headers, allow_redirects=False) as res:
+                size = len(await res.read())
+                status = res.status
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            size, status = 0, None
+        samples.append((time.perf_counter() - start, status, size))
+
+
+async def run_route(session, base, route, args, urls):
+    await asyncio.gather(*[hammer(session, base, route, args, urls[0], args.warmup, []) for _ in range(args.concurrency)])
+    before = await upstream_requests(session, urls)
+    samples = []
+    start = time.perf_counter()
+    await asyncio.gather(*[hammer(session, base, route, args, urls[0], args.duration, samples) for _ in range(args.concurrency)])
+    seconds = time.perf_counter() - start
+    upstream = await upstream_requests(session, urls) - before
+    latencies = sorted(s[0] for s in samples)
+    # リダイレクト(Cookieが付いていない)も失敗に数える
+    errors = sum(1 for _, status, _ in samples if status not in (200, 206, 304))
+    ms = lambda v: round(v * 1000, 2) if v is not None else None  # noqa: E731
+    return {
+        "route": route, "requests": len(samples), "errors": errors, "seconds": round(seconds, 3),
+        "rps": round(len(samples) / seconds, 1), "mb_per_s": round(sum(s[2] for s in samples) / seconds / 1e6, 2),
+        "p50_ms": ms(percentile(latencies, 0.5)), "p95_ms": ms(percentile(latencies, 0.95)), "p99_ms": ms(percentile(latencies, 0.99)),
+        "max_ms": ms(latencies[-1] if latencies else None),
+        "upstream_requests": upstream, "upstream_per_request": round(upstream / len(samples), 3) if samples else None,
+    }
+
+
+async def wait_ready(base, server, timeout=60):
+    deadline = time.time() + timeout
+    async with aiohttp.ClientSession() as session:
+        while time.time() < deadline:
+            if server.poll() is not None:
+                raise RuntimeError("the app exited while starting")
+            try:
+                async with session.get(base + "/metrics") as res:
+                    if res.status == 200:
+                        return
+            except aiohttp.ClientError:
+                pass
+            await asyncio.sleep(0.2)
+    raise RuntimeError("the app did not start")
+
+
+async def bench_async(args, base, urls, server):
+    await wait_ready(base, server)
+    results = []
+    print(f"{'route':<11}{'req/s':>9}{'p50(ms)':>10}{'p95(ms)':>10}{'p99(ms)':>10}{'errors':>8}{'up/req':>8}")
+    connector = aiohttp.TCPConnector(limit=0)
+    timeout = aiohttp.ClientTimeout(total=60)
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout, cookies={"yuki": "True"}) as session:
+        for route in args.routes:
+            r = await run_route(session, base, route, args, urls)
+            results.append(r)
+            print(f"{r['route']:<11}{r['rps']:>9}{r['p50_ms']!s:>10}{r['p95_ms']!s:>10}{r['p99_ms']!s:>10}{r['errors']:>8}{r['upstream_per_request']!s:>8}")
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=ROOT, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def bench():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--routes", nargs="+", choices=ROUTES, default=list(ROUTES))
+    parser.add_argument("--duration", type=float, default=10, help="ルートごとに測る時間(秒)")
+    parser.add_argument("--warmup", type=float, default=2, help="測る前に投げて捨てる時間(秒)")
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--keys", type=int, default=50, help="使う動画ID・検索語などの数")
+    parser.add_argument("--workers", type=int, default=1, help="uvicornのワーカー数")
+    parser.add_argument("--instance", action="append", default=[], help="偽Invidiousの「レイテンシ(秒):エラー率」。インスタンスごとに繰り返す")
+    parser.add_argument("--jitter", type=float, default=0.0, help="上流のレイテンシに足すばらつき(秒)")
+    parser.add_argument("--size", type=int, default=20, help="上流の応答の一覧の件数")
+    parser.add_argument("--fixtures", help="fixtures.pyで記録した応答のディレクトリ")
+    parser.add_argument("--media-bytes", type=int, default=8 * 1024 * 1024, help="/umekomiで読む動画の大きさ")
+    parser.add_argument("--range-bytes", type=int, default=1024 * 1024, help="/umekomiの1リクエストで読む大きさ")
+    parser.add_argument("--port", type=int, default=8766)
+    parser.add_argument("--out", help="結果をJSONで書き出すファイル")
+    args = parser.parse_args()
+    args.instance = args.instance or ["0.05:0", "0.2:0.05"]
+
+    fake_command = [sys.executable, os.path.join(BENCH_DIR, "fake_upstream.py"), "--jitter", str(args.jitter), "--size", str(args.size), "--media-bytes", str(args.media_bytes)]
+    for spec in args.instance:
+        fake_command += ["--instance", spec]
+    if args.fixtures:
+        fake_command += ["--fixtures", args.fixtures]
+    fake = subprocess.Popen(fake_command, stdout=subprocess.PIPE, text=True)
+    server = None
+    try:
+        urls = json.loads(fake.stdout.readline())["urls"]
+        with tempfile.TemporaryDirectory() as state:
+            # インスタンス一覧は共有DBに入れておくと、起動したワーカーがそこから読む
+            db = os.path.join(state, "shared.sqlite3")
+            SharedState(db).set_config("api_list", urls)
+            env = dict(
+                os.environ, YUKI_SHARED_DB=db, YUKI_API_LIST_REFRESH="0", YUKI_LOG_LEVEL=os.environ.get("YUKI_LOG_LEVEL", "error"),
+                YUKI_THUMBNAIL_ORIGIN=urls[0] + "vi/{v}/0.jpg", YUKI_THUMBNAIL_DIR=os.path.join(state, "thumbnails"), YUKI_SEGMENT_DIR=os.path.join(state, "segments"),
+            )
+            env.pop("YUKI_CACHE_DIR", None)
+            server = subprocess.Popen([sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(args.port), "--workers", str(args.workers), "--log-level", "warning"], cwd=ROOT, env=env)
+            results = asyncio.run(bench_async(args, f"http://127.0.0.1:{args.port}", urls, server))
+            server.terminate()
+            server.wait(30)
+    finally:
+        if server is not None and server.poll() is None:
+            server.kill()
+        fake.terminate()
+        fake.wait(10)
+    if args.out:
+        meta = {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"), "commit": git_commit(), "python": platform.python_version(),
+            "args": {k: v for k, v in vars(args).items() if k != "out"},
+        }
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump({"meta": meta, "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    bench()
@@ -0,0 +1,47 @@
+"""main.pyのimport(=起動)に掛かる時間を測る。CIで推移を追うためのもの。
+
+    python bench/startup_time.py --runs 5 --max 2.0 --out startup.json
+
+毎回新しいPythonプロセスでimportするので、モジュールのキャッシュは効かない。
+--maxを付けると中央値がそれを超えたとき終了コード1で終わる。
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCH_DIR)
+
+probe = "import time; t = time.perf_counter(); import main; print(time.perf_counter() - t)"
+
+
+def measure_once(env):
+    out = subprocess.run([sys.executable, "-c", probe], cwd=ROOT, env=env, stdout=subprocess.PIPE, check=True, encoding="utf-8")
+    return float(out.stdout.strip().splitlines()[-1])
+
+
+def bench():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--max", type=float, help="中央値の上限(秒)")
+    parser.add_argument("--out", help="結果をJSONで書き出すファイル")
+    args = parser.parse_args()
+
+    env = dict(os.environ)
+    env["PYTHONDONTWRITEBYTECODE"] = "1"
+    times = [measure_once(env) for _ in range(args.runs)]
+    result = {"runs": args.runs, "median": round(statistics.median(times), 4), "min": round(min(times), 4), "max": round(max(times), 4), "times": [round(t, 4) for t in times]}
+    print(f"import main: median {result['median']:.3f}s  min {result['min']:.3f}s  max {result['max']:.3f}s")
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(result, f, indent=2)
+    if args.max is not None and result["median"] > args.max:
+        print(f"起動時間が上限({args.max}s)を超えました")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    bench()
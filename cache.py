@@ -1,23 +1,418 @@
-from functools import lru_cache, wraps
-from datetime import datetime, timedelta
-from threading import Lock
+import asyncio
+import hashlib
+import json
+import os
+import sys
+import time
+from collections import OrderedDict
+from functools import _make_key, wraps
+from threading import Event, Lock, Thread
 
-def cache(seconds: int, max_size: int = 128, typed: bool = False):
+
+def _sizeof(value):
+    if isinstance(value, (str, bytes, bytearray)):
+        return len(value)
+    return sys.getsizeof(value)
+
+
+def prune_directory(directory, max_bytes):
+    """Drop the least recently written files until the directory fits in max_bytes."""
+    files = []
+    for name in os.listdir(directory):
+        try:
+            st = os.stat(os.path.join(directory, name))
+        except OSError:
+            continue
+        files.append((st.st_mtime, st.st_size, name))
+    total = sum(size for _, size, _ in files)
+    for _, size, name in sorted(files):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(os.path.join(directory, name))
+        except OSError:
+            pass
+        total -= size
+
+
+class _Entry:
+    __slots__ = ("value", "expires", "stale_until", "size")
+
+    def __init__(self, value, expires, stale_until, size):
+        self.value = value
+        self.expires = expires
+        self.stale_until = stale_until
+        self.size = size
+
+
+class _Flight:
+    __slots__ = ("event", "value", "error")
+
+    def __init__(self):
+        self.event = Event()
+        self.value = None
+        self.error = None
+
+
+class DiskTier:
+    """Second cache tier of one file per string entry, kept across restarts.
+
+    Non-string values are stored only when `encode`/`decode` are given to turn
+    them into text and back.
+    """
+
+    def __init__(self, directory, max_bytes=256 * 1024 * 1024, encode=None, decode=None):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.encode = encode
+        self.decode = decode
+        self._written = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, hashlib.sha1(str(key).encode("utf-8")).hexdigest())
+
+    def get(self, key):
+        try:
+            with open(self._path(key), "r", encoding="utf-8") as f:
+                header = json.loads(f.readline())
+                if header["key"] != str(key) or time.time() >= header["stale_until"]:
+                    return None
+                value = f.read()
+            if self.decode is not None:
+                value = self.decode(value)
+            return value, header["expires"], header["stale_until"]
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def set(self, key, value, expires, stale_until):
+        if self.encode is not None:
+            value = self.encode(value)
+        if not isinstance(value, str):
+            return
+        path = self._path(key)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp, "w", encoding="utf-8") as f:
+                f.write(json.dumps({"key": str(key), "expires": expires, "stale_until": stale_until}) + "\n")
+                f.write(value)
+            os.replace(tmp, path)
+        except OSError:
+            return
+        self._written += len(value)
+        if self._written > self.max_bytes // 8:
+            self._written = 0
+            self.prune()
+
+    def delete(self, key):
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+    def prune(self):
+        prune_directory(self.directory, self.max_bytes)
+
+
+class TTLCache:
+    """Per-entry TTL cache bounded by entry count and bytes.
+
+    Entries past their TTL but still within `stale` seconds are returned as-is
+    while one background refresh runs. Concurrent misses for the same key share
+    a single load. An optional DiskTier is consulted on memory misses and
+    written through on every store; on the async path both happen in a worker
+    thread outside the lock, so a slow disk never stalls the event loop.
+    """
+
+    def __init__(self, ttl, max_entries=128, max_bytes=None, stale=0, sizeof=_sizeof, disk=None):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.stale = stale
+        self.sizeof = sizeof
+        self.disk = disk
+        self._lock = Lock()
+        self._entries = OrderedDict()
+        self._flights = {}
+        self._aflights = {}
+        self._writes = set()
+        self._bytes = 0
+        self._counters = dict.fromkeys(("hits", "stale_hits", "disk_hits", "misses", "coalesced", "evictions", "expirations", "refreshes", "errors"), 0)
+
+    def _ttl_for(self, value, ttl):
+        ttl = self.ttl if ttl is None else ttl
+        return ttl(value) if callable(ttl) else ttl
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        self._bytes -= entry.size
+
+    def _store(self, key, value, ttl, stale=None, expires=None, stale_until=None):
+        if expires is None:
+            seconds = self._ttl_for(value, ttl)
+            if seconds <= 0:
+                return None
+            expires = time.time() + seconds
+            stale_until = expires + (self.stale if stale is None else stale)
+        size = self.sizeof(value)
+        if self.max_bytes is not None and size > self.max_bytes:
+            return expires, stale_until
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = _Entry(value, expires, stale_until, size)
+        self._bytes += size
+        self._shrink()
+        return expires, stale_until
+
+    def _shrink(self):
+        while self._entries and (len(self._entries) > self.max_entries or (self.max_bytes is not None and self._bytes > self.max_bytes)):
+            self._remove(next(iter(self._entries)))
+            self._counters["evictions"] += 1
+
+    def _persist(self, key, value, stored):
+        if self.disk is not None and stored is not None:
+            self.disk.set(key, value, *stored)
+
+    def _apersist(self, key, value, stored):
+        if self.disk is not None and stored is not None:
+            task = asyncio.ensure_future(asyncio.to_thread(self.disk.set, key, value, *stored))
+            self._writes.add(task)
+            task.add_done_callback(self._writes.discard)
+            task.add_done_callback(_consume)
+
+    def _restore(self, key, found):
+        if found is None or key in self._entries:
+            return
+        self._counters["disk_hits"] += 1
+        value, expires, stale_until = found
+        self._store(key, value, None, expires=expires, stale_until=stale_until)
+
+    def _lookup(self, key, now, disk=True):
+        entry = self._entries.get(key)
+        if entry is None:
+            if self.disk is None or not disk:
+                return None
+            self._restore(key, self.disk.get(key))
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+        if now >= entry.stale_until:
+            self._remove(key)
+            self._counters["expirations"] += 1
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    def set(self, key, value, ttl=None, stale=None):
+        with self._lock:
+            stored = self._store(key, value, ttl, stale)
+        self._persist(key, value, stored)
+
+    def resize(self, key):
+        """Measure the entry for `key` again after its value grew in place."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return
+            size = self.sizeof(entry.value)
+            self._bytes += size - entry.size
+            entry.size = size
+            if self.max_bytes is not None and size > self.max_bytes:
+                self._remove(key)
+                self._counters["evictions"] += 1
+            self._shrink()
+
+    def get(self, key, default=None, disk=True):
+        with self._lock:
+            entry = self._lookup(key, time.time(), disk)
+            if entry is None or time.time() >= entry.expires:
+                return default
+            return entry.value
+
+    def delete(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+        if self.disk is not None:
+            self.disk.delete(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        # Memory only, so it is safe to ask from the event loop.
+        return self.get(key, _missing, disk=False) is not _missing
+
+    def _run_flight(self, key, flight, loader, ttl, stale):
+        try:
+            value = loader()
+        except BaseException as e:
+            flight.error = e
+            with self._lock:
+                self._counters["errors"] += 1
+                del self._flights[key]
+            flight.event.set()
+            raise
+        flight.value = value
+        with self._lock:
+            stored = self._store(key, value, ttl, stale)
+            del self._flights[key]
+        flight.event.set()
+        self._persist(key, value, stored)
+        return value
+
+    def _refresh(self, key, flight, loader, ttl, stale):
+        try:
+            self._run_flight(key, flight, loader, ttl, stale)
+        except Exception:
+            pass
+
+    def get_or_load(self, key, loader, ttl=None, stale=None):
+        """Return the cached value for `key`, calling `loader()` at most once across threads on a miss.
+
+        `ttl` may be a number or a function of the loaded value; `stale` overrides
+        the cache-wide stale window for this entry.
+        """
+        now = time.time()
+        with self._lock:
+            entry = self._lookup(key, now)
+            if entry is not None:
+                if now < entry.expires:
+                    self._counters["hits"] += 1
+                    return entry.value
+                self._counters["stale_hits"] += 1
+                if key not in self._flights:
+                    self._counters["refreshes"] += 1
+                    flight = self._flights[key] = _Flight()
+                    Thread(target=self._refresh, args=(key, flight, loader, ttl, stale), daemon=True).start()
+                return entry.value
+            flight = self._flights.get(key)
+            if flight is not None:
+                self._counters["coalesced"] += 1
+                owner = False
+            else:
+                self._counters["misses"] += 1
+                flight = self._flights[key] = _Flight()
+                owner = True
+        if owner:
+            return self._run_flight(key, flight, loader, ttl, stale)
+        flight.event.wait()
+        if flight.error is not None:
+            raise flight.error
+        return flight.value
+
+    def _start(self, key, loader, ttl, stale):
+        task = asyncio.ensure_future(self._aload(key, loader, ttl, stale))
+        task.add_done_callback(_consume)
+        return task
+
+    async def _aload(self, key, loader, ttl, stale):
+        try:
+            value = await loader()
+        except BaseException:
+            with self._lock:
+                self._counters["errors"] += 1
+                del self._aflights[key]
+            raise
+        with self._lock:
+            stored = self._store(key, value, ttl, stale)
+            del self._aflights[key]
+        self._apersist(key, value, stored)
+        return value
+
+    def _ajoin(self, key, loader, ttl, stale, miss):
+        # Call with the lock held. Returns (value, None), (None, task to await),
+        # or (_missing, None) when the memory tier has nothing and miss is False.
+        now = time.time()
+        entry = self._lookup(key, now, disk=False)
+        if entry is not None:
+            if now < entry.expires:
+                self._counters["hits"] += 1
+                return entry.value, None
+            self._counters["stale_hits"] += 1
+            if key not in self._aflights:
+                self._counters["refreshes"] += 1
+                self._aflights[key] = self._start(key, loader, ttl, stale)
+            return entry.value, None
+        task = self._aflights.get(key)
+        if task is not None:
+            self._counters["coalesced"] += 1
+            return None, task
+        if not miss:
+            return _missing, None
+        self._counters["misses"] += 1
+        task = self._aflights[key] = self._start(key, loader, ttl, stale)
+        return None, task
+
+    async def aget_or_load(self, key, loader, ttl=None, stale=None):
+        """Async counterpart of get_or_load; `loader` returns an awaitable.
+
+        The load runs as its own task, so a cancelled caller does not cancel it
+        for the others waiting on the same key.
+        """
+        with self._lock:
+            value, task = self._ajoin(key, loader, ttl, stale, miss=self.disk is None)
+        if value is _missing:
+            found = await asyncio.to_thread(self.disk.get, key)
+            with self._lock:
+                self._restore(key, found)
+                value, task = self._ajoin(key, loader, ttl, stale, miss=True)
+        if task is None:
+            return value
+        return await asyncio.shield(task)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+            stats["entries"] = len(self._entries)
+            stats["bytes"] = self._bytes
+            stats["max_entries"] = self.max_entries
+            stats["max_bytes"] = self.max_bytes
+        lookups = stats["hits"] + stats["stale_hits"] + stats["misses"] + stats["coalesced"]
+        stats["hit_rate"] = (stats["hits"] + stats["stale_hits"]) / lookups if lookups else 0.0
+        return stats
+
+
+_missing = object()
+
+
+def _consume(task):
+    if not task.cancelled():
+        task.exception()
+
+
+def cache(seconds: int, max_size: int = 128, typed: bool = False, max_bytes: int = None, stale: int = 0):
     def wrapper(f):
-        func = lru_cache(maxsize=max_size, typed=typed)(f)
-        func.ttl = seconds
-        func.expire = datetime.utcnow() + timedelta(seconds=func.ttl)
+        engine = TTLCache(seconds, max_entries=max_size, max_bytes=max_bytes, stale=stale)
 
         @wraps(f)
         def inner(*args, **kwargs):
-            with Lock():
-                if datetime.utcnow() > func.expire:
-                    func.cache_clear()
-                    func.expire = datetime.utcnow() + timedelta(seconds=func.ttl)
-                return func(*args, **kwargs)
-
-        inner.clear_cache = func.cache_clear
-        inner.cache_info = func.cache_info
+            return engine.get_or_load(_make_key(args, kwargs, typed), lambda: f(*args, **kwargs))
+
+        inner.cache = engine
+        inner.clear_cache = engine.clear
+        inner.cache_info = engine.stats
+        return inner
+
+    return wrapper
+
+
+def acache(seconds: int, max_size: int = 128, typed: bool = False, max_bytes: int = None, stale: int = 0):
+    def wrapper(f):
+        engine = TTLCache(seconds, max_entries=max_size, max_bytes=max_bytes, stale=stale)
+
+        @wraps(f)
+        async def inner(*args, **kwargs):
+            return await engine.aget_or_load(_make_key(args, kwargs, typed), lambda: f(*args, **kwargs))
+
+        inner.cache = engine
+        inner.clear_cache = engine.clear
+        inner.cache_info = engine.stats
         return inner
 
-    return wrapper
\ No newline at end of file
+    return wrapper
@@ -0,0 +1,232 @@
+import time
+from threading import Lock
+
+# インスタンスの健康状態を管理するレジストリ
+# エンドポイント種別(video/api/channel/comments)ごとにレイテンシのEWMAと成功率を持ち、
+# 連続失敗がたまったインスタンスはサーキットを開いてしばらく候補から外す。
+# サーキットに数えるのは通信エラー・タイムアウト・5xxだけ(record_failure)。応答が壊れていた
+# (record_invalid)ときはその種別の成功率だけ下げ、インスタンス単位のサーキットには触らない。
+# attachで共有ストアを付けると、記録はsyncのたびに他のワーカープロセスの分と合わせられる。
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half-open"
+
+
+class _Stats:
+    __slots__ = ("latency", "success_rate", "successes", "failures")
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.success_rate = 1.0
+        self.successes = 0
+        self.failures = 0
+
+
+class _Circuit:
+    __slots__ = ("consecutive_failures", "opened_until", "trips", "probe_until")
+
+    def __init__(self):
+        self.consecutive_failures = 0
+        self.opened_until = 0.0
+        self.trips = 0
+        self.probe_until = 0.0
+
+
+class InstanceHealth:
+    def __init__(self, instances, alpha=0.3, default_latency=2.0, failure_threshold=3, open_seconds=30, max_open_seconds=600, probe_timeout=8):
+        self.alpha = alpha
+        self.default_latency = default_latency
+        self.failure_threshold = failure_threshold
+        self.open_seconds = open_seconds
+        self.max_open_seconds = max_open_seconds
+        self.probe_timeout = probe_timeout
+        self._lock = Lock()
+        self._stats = {}
+        self._circuits = {}
+        self._instances = []
+        self.store = None
+        self.max_age = None
+        self.max_pending = 10000
+        self._events = []  # まだ共有ストアに書いていない記録
+        self.set_instances(instances)
+
+    def set_instances(self, instances):
+        with self._lock:
+            self._instances = list(dict.fromkeys(instances))
+            for api in self._instances:
+                self._circuits.setdefault(api, _Circuit())
+
+    @property
+    def instances(self):
+        return list(self._instances)
+
+    @property
+    def pending(self):
+        return len(self._events)
+
+    def _state(self, circuit, now):
+        if circuit.opened_until == 0:
+            return CLOSED
+        if now < circuit.opened_until:
+            return OPEN
+        return HALF_OPEN
+
+    def expected_latency(self, kind, api):
+        # 成功するまでに掛かる時間の期待値。成功率が低いほど大きくなる
+        stat = self._stats.get((kind, api))
+        if stat is None:
+            return self.default_latency
+        return stat.latency / max(stat.success_rate, 0.05)
+
+    def ranking(self, kind):
+        """サーキットが閉じているインスタンスを期待レイテンシ順に返す。"""
+        now = time.time()
+        with self._lock:
+            order = {api: i for i, api in enumerate(self._instances)}
+            closed = [api for api in self._instances if self._state(self._circuits[api], now) == CLOSED]
+            return sorted(closed, key=lambda api: (self.expected_latency(kind, api), order[api]))
+
+    def candidates(self, kind):
+        """リクエストに使う候補順。閉じているものが無ければ、一番早く開け直すインスタンスだけを試す。"""
+        ranked = self.ranking(kind)
+        if ranked:
+            return ranked
+        with self._lock:
+            if not self._instances:
+                return []
+            # 通信の瞬断などで全部開いても、待ち時間が明けるまで一切問い合わせないことにはしない
+            return [min(self._instances, key=lambda api: self._circuits[api].opened_until)]
+
+    def probe(self):
+        """誰も試していない半開状態のインスタンスを1件、試験中として記録して返す。無ければNone。
+
+        呼んだ側はすぐにそのインスタンスへリクエストを送ること。"""
+        now = time.time()
+        with self._lock:
+            for api in self._instances:
+                circuit = self._circuits[api]
+                if self._state(circuit, now) == HALF_OPEN and now >= circuit.probe_until:
+                    # 他のワーカーも同時に試験しないよう共有ストアにも残す
+                    self._record(("probe", None, api, None, now))
+                    return api
+        return None
+
+    def _apply(self, stats, circuits, event):
+        action, kind, api, latency, now = event
+        circuit = circuits.setdefault(api, _Circuit())
+        if action == "probe":
+            circuit.probe_until = max(circuit.probe_until, now + self.probe_timeout)
+            return
+        stat = stats.get((kind, api))
+        if stat is None:
+            stat = stats[(kind, api)] = _Stats(self.default_latency)
+        if action == "success":
+            stat.latency += self.alpha * (latency - stat.latency)
+            stat.success_rate += self.alpha * (1.0 - stat.success_rate)
+            stat.successes += 1
+            circuit.consecutive_failures = 0
+            circuit.opened_until = 0.0
+            circuit.trips = 0
+            circuit.probe_until = 0.0
+            return
+        if latency is not None:
+            stat.latency += self.alpha * (latency - stat.latency)
+        stat.success_rate += self.alpha * (0.0 - stat.success_rate)
+        stat.failures += 1
+        if action == "invalid":
+            return
+        circuit.consecutive_failures += 1
+        state = self._state(circuit, now)
+        if state == HALF_OPEN or (state == CLOSED and circuit.consecutive_failures >= self.failure_threshold):
+            # 開くたびに閉じている時間を倍にする
+            circuit.trips += 1
+            circuit.opened_until = now + min(self.open_seconds * 2 ** (circuit.trips - 1), self.max_open_seconds)
+            circuit.probe_until = 0.0
+
+    def _record(self, event):
+        # ロックを持った状態で呼ぶ
+        self._apply(self._stats, self._circuits, event)
+        if self.store is not None:
+            self._events.append(event)
+            if len(self._events) > self.max_pending:
+                del self._events[:len(self._events) - self.max_pending]
+
+    def record_success(self, kind, api, latency):
+        with self._lock:
+            self._record(("success", kind, api, latency, time.time()))
+
+    def record_failure(self, kind, api, latency=None):
+        with self._lock:
+            self._record(("failure", kind, api, latency, time.time()))
+
+    def record_invalid(self, kind, api, latency=None):
+        with self._lock:
+            self._record(("invalid", kind, api, latency, time.time()))
+
+    def snapshot(self, kind):
+        """/info表示用の現在の順位。"""
+        now = time.time()
+        ranked = self.ranking(kind)
+        rest = [api for api in self._instances if api not in ranked]
+        rows = []
+        with self._lock:
+            for api in ranked + rest:
+                stat = self._stats.get((kind, api))
+                circuit = self._circuits[api]
+                rows.append({
+                    "api": api,
+                    "state": self._state(circuit, now),
+                    "latency": round(stat.latency, 3) if stat else None,
+                    "success_rate": round(stat.success_rate, 3) if stat else None,
+                    "successes": stat.successes if stat else 0,
+                    "failures": stat.failures if stat else 0,
+                    "consecutive_failures": circuit.consecutive_failures,
+                })
+        return rows
+
+    def attach(self, store, max_age=None):
+        """共有ストア(shared_state.SharedState)を使い、他のプロセスと統計とサーキットを共有する。
+
+        以後のrecord_*はsync()でまとめて書き込まれる。max_age秒より前から更新のない統計は読まない。"""
+        self.store = store
+        self.max_age = max_age
+        self.sync()
+
+    def sync(self):
+        """溜まった記録を共有ストアの状態に順に当てて書き戻し、他のプロセスの分も合わせた状態を読み戻す。"""
+        if self.store is None:
+            return
+        with self._lock:
+            events, self._events = self._events, []
+        stats, circuits = {}, {}
+        try:
+            with self.store.transaction():
+                stat_rows, circuit_rows = self.store.read_health(self.max_age)
+                for kind, api, latency, success_rate, successes, failures in stat_rows:
+                    stat = stats[(kind, api)] = _Stats(latency)
+                    stat.success_rate, stat.successes, stat.failures = success_rate, successes, failures
+                for api, consecutive_failures, opened_until, trips, probe_until in circuit_rows:
+                    circuit = circuits[api] = _Circuit()
+                    circuit.consecutive_failures, circuit.opened_until, circuit.trips, circuit.probe_until = consecutive_failures, opened_until, trips, probe_until
+                for event in events:
+                    self._apply(stats, circuits, event)
+                if events:
+                    touched_stats = {(kind, api) for action, kind, api, _, _ in events if action != "probe"}
+                    touched_circuits = {api for action, _, api, _, _ in events if action != "invalid"}
+                    self.store.write_health(
+                        [(kind, api, stat.latency, stat.success_rate, stat.successes, stat.failures) for (kind, api), stat in stats.items() if (kind, api) in touched_stats],
+                        [(api, c.consecutive_failures, c.opened_until, c.trips, c.probe_until) for api, c in circuits.items() if api in touched_circuits],
+                    )
+        except Exception:
+            # 書き込めなかった分は次のsyncでもう一度
+            with self._lock:
+                self._events[:0] = events
+            raise
+        with self._lock:
+            # 読み書きしている間に増えた記録はまだ共有ストアに無いので、読み戻した状態にも当てておく
+            for event in self._events:
+                self._apply(stats, circuits, event)
+            for api in self._instances:
+                circuits.setdefault(api, _Circuit())
+            self._stats, self._circuits = stats, circuits
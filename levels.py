@@ -0,0 +1,85 @@
+import asyncio
+import os
+from threading import Lock
+
+# 単語のレベル表(Level1.txt〜Level12.txt)をメモリ上の辞書にしたもの
+# 起動時にreload()で一度作っておき、その後はrun_refresh()が裏でcheck_interval秒ごとに
+# ファイルの更新を確認して、変わっていたら別スレッドで作り直した辞書に丸ごと差し替える。
+# 引く側はディスクに触らず、今の辞書を見るだけ。ただし起動時の処理が走らない環境
+# (lifespanイベントを送らないホストなど)では、最初に引かれたときにその場で作る。
+
+
+class LevelIndex:
+    def __init__(self, directory=".", levels=range(1, 13), check_interval=5):
+        self.directory = directory
+        self.levels = list(levels)
+        self.check_interval = check_interval
+        self._lock = Lock()
+        self._words = {}
+        self._signature = None
+
+    def _path(self, level):
+        return os.path.join(self.directory, f"Level{level}.txt")
+
+    def _current_signature(self):
+        signature = []
+        for level in self.levels:
+            try:
+                st = os.stat(self._path(level))
+                signature.append((st.st_mtime_ns, st.st_size))
+            except OSError:
+                signature.append(None)
+        return tuple(signature)
+
+    def _build(self):
+        words = {}
+        for level in self.levels:
+            try:
+                with open(self._path(level), "r", encoding="UTF-8", newline="\n") as f:
+                    for line in f:
+                        # 同じ単語が複数のレベルにあれば低いレベルを採用する
+                        words.setdefault(line.rstrip("\r\n"), level)
+            except OSError:
+                continue
+        return words
+
+    def refresh(self):
+        """ファイルが変わっていれば読み直す。読み直したらTrue。"""
+        with self._lock:
+            signature = self._current_signature()
+            if signature == self._signature:
+                return False
+            self._words = self._build()
+            self._signature = signature
+            return True
+
+    def reload(self):
+        with self._lock:
+            self._words = self._build()
+            self._signature = self._current_signature()
+
+    def _ensure_built(self):
+        if self._signature is None:
+            with self._lock:
+                if self._signature is None:
+                    self._words = self._build()
+                    self._signature = self._current_signature()
+
+    async def run_refresh(self):
+        while True:
+            await asyncio.sleep(self.check_interval)
+            await asyncio.to_thread(self.refresh)
+
+    def level(self, word):
+        """単語のレベル。どのファイルにもなければ0。"""
+        self._ensure_built()
+        return self._words.get(word, 0)
+
+    def levels_of(self, words):
+        self._ensure_built()
+        table = self._words
+        return {word: table.get(word, 0) for word in words}
+
+    def __len__(self):
+        self._ensure_built()
+        return len(self._words)
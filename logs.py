@@ -0,0 +1,39 @@
+import json
+import os
+import sys
+import time
+
+# 構造化ログ
+# 1行に1つのJSONを出す。YUKI_LOG_LEVEL(debug/info/warning/error)より低いレベルのものは組み立てる前に捨てる。
+
+levels = {"debug": 10, "info": 20, "warning": 30, "error": 40}
+threshold = levels.get(os.environ.get("YUKI_LOG_LEVEL", "info").lower(), levels["info"])
+
+
+def enabled(level):
+    return levels[level] >= threshold
+
+
+def log(level, msg, **fields):
+    if levels[level] < threshold:
+        return
+    record = {"time": time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime()), "level": level, "msg": msg}
+    record.update(fields)
+    sys.stdout.write(json.dumps(record, ensure_ascii=False, default=str) + "\n")
+    sys.stdout.flush()
+
+
+def debug(msg, **fields):
+    log("debug", msg, **fields)
+
+
+def info(msg, **fields):
+    log("info", msg, **fields)
+
+
+def warning(msg, **fields):
+    log("warning", msg, **fields)
+
+
+def error(msg, **fields):
+    log("error", msg, **fields)
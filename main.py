@@ -1,248 +1,440 @@
+import asyncio
 import json
-import requests
+import logs
+import metrics
+import records
+import upstream
 import urllib.parse
 import time
-import datetime
 import random
 import os
-import subprocess
-from cache import cache
+import tempfile
+from cache import acache, TTLCache, DiskTier
+from health import InstanceHealth
+from segment_cache import SegmentCache, OriginError, adaptive_chunks
+from thumbnails import ThumbnailStore
+from levels import LevelIndex
+from verifier import VerifyCodeProvider
+from bbs_feed import FeedHub
+from suggest import SuggestionCache, parse_jsonp
+from prefetch import PrefetchScheduler
+from pages import PageCache, PrecompressedStaticFiles
+from shared_state import SharedState, SharedCacheTier
+import shared_state
 import ast 
 
 
 max_api_wait_time = 8
 max_time = 12
-apis = ast.literal_eval(requests.get('https://raw.githubusercontent.com/siawaseok3/yuki-by-siawaseok/refs/heads/main/api_list.txt').text)
-url = "https://yukibbs-server.onrender.com/"
+hedge_delay = float(os.environ.get("YUKI_HEDGE_DELAY", "0.5"))  # 次のインスタンスへ投げるまでの待ち時間(秒)。0なら同時に投げる
+hedge_width = int(os.environ.get("YUKI_HEDGE_WIDTH", "2"))  # 先頭以外に同時に投げるインスタンス数
+api_list_url = 'https://raw.githubusercontent.com/siawaseok3/yuki-by-siawaseok/refs/heads/main/api_list.txt'
+api_list_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), "api_list.txt")
+api_list_refresh = float(os.environ.get("YUKI_API_LIST_REFRESH", "3600"))  # リモートの一覧を取り直す間隔(秒)。0なら取りに行かない
+health_max_age = float(os.environ.get("YUKI_HEALTH_SNAPSHOT_MAX_AGE", "86400"))  # これより前から更新のない統計・一覧は起動時に使わない
+bbs_default_url = "https://yukibbs-server.onrender.com/"
 version = "1.0"
 
-os.system("chmod 777 ./yukiverify")
 
-# APIリストのコピーを生成
-apichannels = apis.copy()
-apicomments = apis.copy()
+def parse_api_list(text):
+    apis = ast.literal_eval(text)
+    if not isinstance(apis, list) or not apis or not all(isinstance(api, str) for api in apis):
+        raise ValueError("api_list is not a list of urls")
+    return apis
+
+
+def load_local_api_list():
+    # 起動時はネットワークを使わず、同梱のapi_list.txtを読む
+    try:
+        with open(api_list_file, "r", encoding="utf-8") as f:
+            return parse_api_list(f.read())
+    except (OSError, ValueError, SyntaxError) as e:
+        logs.error("同梱のAPI一覧を読めませんでした", error=str(e))
+        return []
+
+
+# ワーカープロセス間で共有する状態(設定・インスタンスの健康状態・レスポンスキャッシュ)
+# YUKI_SHARED_DBを空にするとこのプロセスだけで持つ
+shared = SharedState(os.environ.get("YUKI_SHARED_DB", os.path.join(tempfile.gettempdir(), "yuki-shared.sqlite3")) or ":memory:")
+shared_sync_interval = float(os.environ.get("YUKI_SHARED_SYNC", "1"))  # 健康状態と設定を共有DBと合わせる間隔(秒)
+
+
+# 掲示板のURL。/load_instanceで切り替えたものが全ワーカーに効くよう共有DBに置き、
+# 手元の値はsync_sharedが裏のスレッドで読み直す(リクエストの中では共有DBを待たない)
+bbs_current = shared.get_config("bbs_url", bbs_default_url)
+
+def bbs_url():
+    return bbs_current
+
+def set_bbs_url(url):
+    global bbs_current
+    bbs_current = url
+    shared.set_config("bbs_url", url)
+
+
+# yukiverifyが同梱されていれば実行できるようにしておく(シェルは起動しない)
+try:
+    os.chmod("./yukiverify", 0o777)
+except OSError:
+    pass
+
+# インスタンスの健康状態(全エンドポイント共通のレジストリ)
+# 他のワーカーや前回の起動で取り直した一覧があればそちらから始め、統計は共有DBを通して全ワーカーで合わせる
+health = InstanceHealth(shared.get_config("api_list", max_age=health_max_age) or load_local_api_list(), probe_timeout=max_api_wait_time)
+if shared.persistent:
+    health.attach(shared, max_age=health_max_age)
+
+# /umekomiのセグメントキャッシュ。YUKI_SEGMENT_CACHE_BYTES=0で無効
+segment_cache_bytes = int(os.environ.get("YUKI_SEGMENT_CACHE_BYTES", str(1024 * 1024 * 1024)))
+segments = SegmentCache(os.environ.get("YUKI_SEGMENT_DIR", os.path.join(tempfile.gettempdir(), "yuki-segments")), segment_cache_bytes) if segment_cache_bytes > 0 else None
+
+# サムネイルのメモリ+ディスクキャッシュ。YUKI_THUMBNAIL_ORIGINで取りに行く先を変えられる({v}が動画ID)
+thumbnails = ThumbnailStore(
+    os.environ.get("YUKI_THUMBNAIL_DIR", os.path.join(tempfile.gettempdir(), "yuki-thumbnails")),
+    origin=os.environ.get("YUKI_THUMBNAIL_ORIGIN", "https://img.youtube.com/vi/{v}/0.jpg"),
+)
+
+# メトリクス(/metrics でPrometheus形式)
+registry = metrics.Registry()
+route_seconds = registry.histogram("yuki_http_request_duration_seconds", "Time spent serving a request, by route.", ("route", "method", "status"))
+attempt_seconds = registry.histogram("yuki_upstream_attempt_duration_seconds", "Time of a single request to an upstream instance, by outcome (ok, rejected, invalid, timeout, error, cancelled).", ("kind", "instance", "outcome"))
+upstream_errors = registry.counter("yuki_upstream_errors_total", "Failed requests to an upstream instance, by reason (invalid, timeout, error).", ("kind", "instance", "reason"))
+hedged_seconds = registry.histogram("yuki_api_request_duration_seconds", "Time until a hedged API request succeeded, was rejected (404, 410 or empty result) or timed out.", ("kind", "result"))
+
+
+def record_attempt(kind, api, outcome, seconds):
+    attempt_seconds.observe(seconds, kind=kind, instance=api, outcome=outcome)
+    if outcome not in ("ok", "rejected", "cancelled"):
+        upstream_errors.inc(kind=kind, instance=api, reason=outcome)
+    logs.debug("上流へのリクエスト", kind=kind, instance=api, outcome=outcome, seconds=round(seconds, 3))
+
+
+def failure_reason(e):
+    return "timeout" if isinstance(e, upstream.timeout_errors) else "error"
+
+
+def record_result(kind, label, result, starttime, api=None, errmsg="APIがタイムアウトしました"):
+    seconds = time.time() - starttime
+    hedged_seconds.observe(seconds, kind=kind, result=result)
+    if result == "ok":
+        logs.debug(f"{label}成功したAPI", kind=kind, instance=api, seconds=round(seconds, 3))
+    elif result == "rejected":
+        logs.info(f"{label}の結果がありませんでした", kind=kind, instance=api, seconds=round(seconds, 3))
+    else:
+        logs.warning(errmsg, kind=kind, label=label, seconds=round(seconds, 3))
+
 
 # 例外クラスの定義
 class APItimeoutError(Exception):
     pass
 
-# JSON判定
-def is_json(json_str):
-    try:
-        json.loads(json_str)
-        return True
-    except json.JSONDecodeError:
-        return False
-
-# 汎用リクエスト
-def apirequest(url):
-    global apis
+# ヘッジリクエスト
+# 期待レイテンシが一番小さいインスタンスに投げてからhedge_delay秒ごとに次のインスタンスへも投げ、
+# 最初に200かつdecodeできたものを採用する。同時に投げるのは最大1+hedge_width件。
+# 半開状態のインスタンスの試験はその枠とは別に、最初のリクエストと同時に送る。
+# 試験は勝負がついても取り消さず、結果がhealthに残るまで続ける。
+# 通信エラー・タイムアウト・5xx・429や403などの4xxはインスタンスの失敗としてサーキットに数え、次のインスタンスを待つ。
+# decodeが例外を出した(壊れた応答)ときはその種別の成功率だけ下げて、やはり次を待つ。
+# 404・410やdecodeがNoneを返した(存在しない動画・動画の無いチャンネルなど)ときは
+# どのインスタンスに聞いても同じなので、インスタンスを責めずにそこで打ち切る。
+# 待っている間はイベントループを塞がず、勝負がついたら残りのリクエストはキャンセルする。
+# キャンセルしたものはhealthには記録せず、メトリクスに"cancelled"として残すだけ。
+_rejected = object()
+probe_tasks = set()
+
+def _consume_task(task):
+    # 勝負がついた後で失敗した試験の例外を拾っておく
+    if not task.cancelled():
+        task.exception()
+
+async def hedged_request_async(kind, url, label, errmsg="APIがタイムアウトしました", decode=records.loads):
     starttime = time.time()
-    for api in apis:
-        if time.time() - starttime >= max_time - 1:
-            break
-        try:
-            res = requests.get(api + url, timeout=max_api_wait_time)
-            if res.status_code == 200 and is_json(res.text):
-                print(f"その他成功したAPI: {api}")  # 成功したAPIをログに出力
-                return res.text
-            else:
-                print(f"その他エラー: {api}")
-                apis.append(api)
-                apis.remove(api)
-        except:
-            print(f"その他タイムアウト: {api}")
-            apis.append(api)
-            apis.remove(api)
-    raise APItimeoutError("APIがタイムアウトしました")
-
-# チャンネル用のリクエスト
-def apichannelrequest(url):
-    global apichannels
-    starttime = time.time()
-    for api in apichannels:
-        if time.time() - starttime >= max_time - 1:
-            break
+    candidates = health.candidates(kind)
+    pending = {}
+    probe = health.probe()
+
+    async def attempt(api):
+        t = time.time()
         try:
-            res = requests.get(api + url, timeout=max_api_wait_time)
-            if res.status_code == 200 and is_json(res.text):
-                print(f"チャンネル成功したAPI: {api}")  # 成功したAPIをログに出力
-                return res.text
-            else:
-                print(f"チャンネルエラー: {api}")
-                apichannels.append(api)
-                apichannels.remove(api)
-        except:
-            print(f"チャンネルタイムアウト: {api}")
-            apichannels.append(api)
-            apichannels.remove(api)
-    raise APItimeoutError("APIがタイムアウトしました")
-
-# コメント用のリクエスト
-def apicommentsrequest(url):
-    global apicomments
-    starttime = time.time()
-    for api in apicomments:
-        if time.time() - starttime >= max_time - 1:
-            break
+            res = await upstream.aget(api + url, timeout=max_api_wait_time)
+        except asyncio.CancelledError:
+            # ヘッジで負けて取り消された
+            record_attempt(kind, api, "cancelled", time.time() - t)
+            raise
+        except Exception as e:
+            health.record_failure(kind, api, time.time() - t)
+            record_attempt(kind, api, failure_reason(e), time.time() - t)
+            raise
+        if res.status_code in (404, 410):
+            record_attempt(kind, api, "rejected", time.time() - t)
+            return _rejected
+        if res.status_code != 200:
+            # 制限(429)やブロック(403)はそのインスタンスだけの問題
+            health.record_failure(kind, api, time.time() - t)
+            record_attempt(kind, api, "error", time.time() - t)
+            return None
         try:
-            res = requests.get(api + url, timeout=max_api_wait_time)
-            if res.status_code == 200 and is_json(res.text):
-                print(f"コメント成功したAPI: {api}")  # 成功したAPIをログに出力
-                return res.text
-            else:
-                print(f"コメントエラー: {api}")
-                apicomments.append(api)
-                apicomments.remove(api)
-        except:
-            print(f"コメントタイムアウト: {api}")
-            apicomments.append(api)
-            apicomments.remove(api)
-    raise APItimeoutError("APIがタイムアウトしました")
-
-
-
-# 動画取得用APIリストの作成
-video_apis = ast.literal_eval(requests.get('https://raw.githubusercontent.com/siawaseok3/yuki-by-siawaseok/refs/heads/main/api_list.txt').text)
-
-# 動画データを取得する関数
-def get_data(videoid):
-    global logs
-    t = json.loads(apirequest_video(r"api/v1/videos/" + urllib.parse.quote(videoid)))
-    print("受け取った動画データ全体:")
-    print(json.dumps(t, indent=4))  # JSON形式でインデントをつけて表示
-
-
-    # 関連動画を解析してリストにする
-    related_videos = [
-        {
-            "id": i["videoId"],
-            "title": i["title"],
-            "authorId": i["authorId"],
-            "author": i["author"],
-            "viewCount": i["viewCount"]  # 再生回数を追加（デフォルトは0）
-        }
-        for i in t["recommendedVideos"]
-    ]
-     
-
-    # 必要な情報をテンプレートに渡す
-    return render_template(
-        'video.html',
-        video_data=json.dumps(t),  # 動画データをJSON形式で渡す
-        related_videos=related_videos,  # 関連動画リスト
-        stream_urls=list(reversed([i["url"] for i in t["formatStreams"]]))[:2],  # 逆順で2つのストリームURL
-        description_html=t["descriptionHtml"].replace("\n", "<br>"),  # 説明文に改行を追加
-        title=t["title"],  # 動画タイトル
-        author_id=t["authorId"],  # 作者ID
-        author=t["author"],  # 作者名
-        author_thumbnail_url=t["authorThumbnails"][-1]["url"],  # 最後のサムネイルURL
-        view_count=t["viewCount"]  # 動画の再生回数
-    )
+            value = decode(res.content)
+        except Exception:
+            health.record_invalid(kind, api, time.time() - t)
+            record_attempt(kind, api, "invalid", time.time() - t)
+            return None
+        if value is None:
+            record_attempt(kind, api, "rejected", time.time() - t)
+            return _rejected
+        health.record_success(kind, api, time.time() - t)
+        record_attempt(kind, api, "ok", time.time() - t)
+        return value
+
+    try:
+        if probe is not None:
+            if probe in candidates:
+                candidates.remove(probe)
+            task = asyncio.ensure_future(attempt(probe))
+            probe_tasks.add(task)
+            task.add_done_callback(probe_tasks.discard)
+            task.add_done_callback(_consume_task)
+            pending[task] = probe
+        while candidates or pending:
+            remaining = max_time - 1 - (time.time() - starttime)
+            if remaining <= 0:
+                break
+            running = sum(1 for api in pending.values() if api != probe)
+            if candidates and running < 1 + hedge_width:
+                api = candidates.pop(0)
+                pending[asyncio.ensure_future(attempt(api))] = api
+                if hedge_delay <= 0:
+                    continue
+                running += 1
+            can_hedge = candidates and running < 1 + hedge_width
+            done, _ = await asyncio.wait(pending, timeout=min(hedge_delay, remaining) if can_hedge else remaining, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                api = pending.pop(task)
+                try:
+                    value = task.result()
+                except Exception:
+                    continue
+                if value is None:
+                    continue
+                if value is _rejected:
+                    record_result(kind, label, "rejected", starttime, api)
+                    raise APItimeoutError(errmsg)
+                record_result(kind, label, "ok", starttime, api)
+                return value
+        record_result(kind, label, "timeout", starttime, errmsg=errmsg)
+        raise APItimeoutError(errmsg)
+    finally:
+        for task, api in pending.items():
+            if api != probe:
+                task.cancel()
+
+async def apirequest_async(url, decode=records.loads):
+    return await hedged_request_async("api", url, "その他", decode=decode)
+
+async def apichannelrequest_async(url, decode=records.loads):
+    return await hedged_request_async("channel", url, "チャンネル", decode=decode)
+
+async def apicommentsrequest_async(url, decode=records.loads):
+    return await hedged_request_async("comments", url, "コメント", decode=decode)
+
+# 動画データを取得する関数(関連動画・ストリームURL・説明文などをまとめたrecords.Video)
+async def get_data(videoid):
+    return await cached_request("video", apirequest_video_async, r"api/v1/videos/" + urllib.parse.quote(videoid), decode=decode_video)
+
+def prefetch_data(videoid):
+    prefetch("video", apirequest_video_async, r"api/v1/videos/" + urllib.parse.quote(videoid), decode=decode_video)
+
+def decode_video(data):
+    if logs.enabled("debug"):
+        logs.debug("受け取った動画データ全体", data=records.loads(data))
+    return records.video(data)
 
 # 動画取得用APIリクエスト関数を作成
-def apirequest_video(url):
-    global video_apis
-    starttime = time.time()
-    for api in video_apis:
-        if time.time() - starttime >= max_time - 1:
-            break
-        try:
-            res = requests.get(api + url, timeout=max_api_wait_time)
-            if res.status_code == 200 and is_json(res.text):
-                print(f"動画API成功: {api}")  # 成功したAPIをログに出力
-                return res.text
-            else:
-                print(f"エラー: {api}")
-                video_apis.append(api)
-                video_apis.remove(api)
-        except:
-            print(f"タイムアウト: {api}")
-            video_apis.append(api)
-            video_apis.remove(api)
-    raise APItimeoutError("動画APIがタイムアウトしました")
-
-
-def get_search(q,page):
-    global logs
-    t = json.loads(apirequest(fr"api/v1/search?q={urllib.parse.quote(q)}&page={page}&hl=jp"))
-    def load_search(i):
-        if i["type"] == "video":
-            return {"title":i["title"],"id":i["videoId"],"authorId":i["authorId"],"author":i["author"],"length":str(datetime.timedelta(seconds=i["lengthSeconds"])),"published":i["publishedText"],"type":"video"}
-        elif i["type"] == "playlist":
-            return {"title":i["title"],"id":i["playlistId"],"thumbnail":i["videos"][0]["videoId"],"count":i["videoCount"],"type":"playlist"}
-        else:
-            if i["authorThumbnails"][-1]["url"].startswith("https"):
-                return {"author":i["author"],"id":i["authorId"],"thumbnail":i["authorThumbnails"][-1]["url"],"type":"channel"}
-            else:
-                return {"author":i["author"],"id":i["authorId"],"thumbnail":r"https://"+i["authorThumbnails"][-1]["url"],"type":"channel"}
-    return [load_search(i) for i in t]
-
-def get_channel(channelid):
-    global apichannels
-    t = json.loads(apichannelrequest(r"api/v1/channels/"+ urllib.parse.quote(channelid)))
-    if t["latestVideos"] == []:
-        print("APIがチャンネルを返しませんでした")
-        apichannels.append(apichannels[0])
-        apichannels.remove(apichannels[0])
-        raise APItimeoutError("APIがチャンネルを返しませんでした")
-    return [[{"title":i["title"],"id":i["videoId"],"authorId":t["authorId"],"author":t["author"],"published":i["publishedText"],"type":"video"} for i in t["latestVideos"]],{"channelname":t["author"],"channelicon":t["authorThumbnails"][-1]["url"],"channelprofile":t["descriptionHtml"]}]
-
-def get_playlist(listid,page):
-    t = json.loads(apirequest(r"/api/v1/playlists/"+ urllib.parse.quote(listid)+"?page="+urllib.parse.quote(page)))["videos"]
-    return [{"title":i["title"],"id":i["videoId"],"authorId":i["authorId"],"author":i["author"],"type":"video"} for i in t]
-
-def get_comments(videoid):
-    t = json.loads(apicommentsrequest(r"api/v1/comments/"+ urllib.parse.quote(videoid)+"?hl=jp"))["comments"]
-    return [{"author":i["author"],"authoricon":i["authorThumbnails"][-1]["url"],"authorid":i["authorId"],"body":i["contentHtml"].replace("\n","<br>")} for i in t]
-
-def get_replies(videoid,key):
-    t = json.loads(apicommentsrequest(fr"api/v1/comments/{videoid}?hmac_key={key}&hl=jp&format=html"))["contentHtml"]
+async def apirequest_video_async(url, decode=records.loads):
+    return await hedged_request_async("video", url, "動画API", "動画APIがタイムアウトしました", decode=decode)
+
+# 動画データはストリームURLの期限(expire)が切れる少し前まで保持する
+video_cache_max_ttl = 3600
+video_cache_margin = 300
+def video_ttl(video):
+    if video.expire is None:
+        return video_cache_max_ttl
+    return max(0, min(video_cache_max_ttl, video.expire - time.time() - video_cache_margin))
+
+# レスポンスキャッシュ
+# リソース種別ごとのキャッシュ時間(秒)と、期限切れ後に裏で更新しつつ古いものを返してよい時間(秒)
+cache_ttls = {"video": video_ttl, "channel": 300, "playlist": 300, "search": 30, "comments": 60}
+cache_stale = {"video": 0, "channel": 600, "playlist": 600, "search": 60, "comments": 120}
+# 値は画面ごとに写したrecordsのレコード
+# 2段目はYUKI_CACHE_DIRを指定すればファイルごとのディスクキャッシュ、なければ共有DB(ワーカー間で共有、再起動後も残る)
+shared_cache_bytes = int(os.environ.get("YUKI_SHARED_CACHE_BYTES", str(256 * 1024 * 1024)))  # 0で共有DBにキャッシュしない
+if os.environ.get("YUKI_CACHE_DIR"):
+    response_disk = DiskTier(os.environ["YUKI_CACHE_DIR"], encode=records.dumps, decode=records.restore)
+elif shared.persistent and shared_cache_bytes > 0:
+    response_disk = SharedCacheTier(shared, shared_cache_bytes, encode=records.dumps, decode=records.restore)
+else:
+    response_disk = None
+response_cache = TTLCache(
+    60,
+    max_entries=int(os.environ.get("YUKI_CACHE_MAX_ENTRIES", "1024")),
+    max_bytes=int(os.environ.get("YUKI_CACHE_MAX_BYTES", str(64 * 1024 * 1024))),
+    sizeof=records.sizeof,
+    disk=response_disk,
+)
+
+# パスとクエリの並びを正規化したキャッシュキー
+def cache_key(resource, url):
+    path, _, query = url.lstrip("/").partition("?")
+    if query:
+        path += "?" + urllib.parse.urlencode(sorted(urllib.parse.parse_qsl(query, keep_blank_values=True)))
+    return f"{resource}:{path}"
+
+async def cached_request(resource, request, url, **kwargs):
+    key = cache_key(resource, url)
+    prefetcher.claim(key, key in response_cache)
+    return await response_cache.aget_or_load(key, lambda: request(url, **kwargs), ttl=cache_ttls[resource], stale=cache_stale[resource])
+
+# 先読み
+# 次に来そうなリクエストをresponse_cacheへ裏で入れておく。YUKI_PREFETCH_CONCURRENCY=0で無効
+prefetcher = PrefetchScheduler(
+    concurrency=int(os.environ.get("YUKI_PREFETCH_CONCURRENCY", "4")),
+    max_queue=int(os.environ.get("YUKI_PREFETCH_QUEUE", "256")),
+)
+prefetch_related = int(os.environ.get("YUKI_PREFETCH_RELATED", "2"))  # /watchのあとに先読みする関連動画の数
+# 優先度(小さいほど先)
+prefetch_priority = {"comments": 0, "search": 1, "video": 2}
+
+def prefetch(resource, request, url, **kwargs):
+    key = cache_key(resource, url)
+    if key in response_cache:
+        return
+    load = lambda: response_cache.aget_or_load(key, lambda: request(url, **kwargs), ttl=cache_ttls[resource], stale=cache_stale[resource])
+    prefetcher.schedule(key, resource, load, prefetch_priority[resource])
+
+
+async def get_search(q,page):
+    return await cached_request("search", apirequest_async, fr"api/v1/search?q={urllib.parse.quote(q)}&page={page}&hl=jp", decode=records.search)
+
+def prefetch_search(q,page):
+    prefetch("search", apirequest_async, fr"api/v1/search?q={urllib.parse.quote(q)}&page={page}&hl=jp", decode=records.search)
+
+# 動画一覧が空のチャンネルはそこで打ち切る(records.channelがNoneを返す)
+async def get_channel(channelid):
+    return await cached_request("channel", apichannelrequest_async, r"api/v1/channels/"+ urllib.parse.quote(channelid), decode=records.channel)
+
+async def get_playlist(listid,page):
+    return await cached_request("playlist", apirequest_async, r"/api/v1/playlists/"+ urllib.parse.quote(listid)+"?page="+urllib.parse.quote(page), decode=records.playlist)
+
+async def get_comments(videoid):
+    return await cached_request("comments", apicommentsrequest_async, r"api/v1/comments/"+ urllib.parse.quote(videoid)+"?hl=jp", decode=records.comments)
+
+def prefetch_comments(videoid):
+    prefetch("comments", apicommentsrequest_async, r"api/v1/comments/"+ urllib.parse.quote(videoid)+"?hl=jp", decode=records.comments)
+
+async def get_replies(videoid,key):
+    return await apicommentsrequest_async(fr"api/v1/comments/{videoid}?hmac_key={key}&hl=jp&format=html", decode=records.replies)
+
+# 単語レベルの索引(起動時にLevel{n}.txtを読み込み、更新されたら裏で読み直す)
+level_index = LevelIndex()
 
 def get_level(word):
-    for i1 in range(1,13):
-        with open(f'Level{i1}.txt', 'r', encoding='UTF-8', newline='\n') as f:
-            if word in [i2.rstrip("\r\n") for i2 in f.readlines()]:
-                return i1
-    return 0
+    return level_index.level(word)
+
+def level_message(t):
+    if t > 5:
+        return f"level{t}\n推測を推奨する"
+    elif t == 0:
+        return "level12以上\nほぼ推測必須"
+    return f"level{t}\n覚えておきたいレベル"
+
+
+# 結果ページに並ぶサムネイルを先に取りに行っておく
+def prefetch_thumbnails(results):
+    thumbnails.prefetch([i["id"] if i["type"] == "video" else i["thumbnail"] for i in results if i["type"] in ("video", "playlist")])
 
 
 def check_cokie(cookie):
-    print(cookie)
     if cookie == "True":
         return True
     return False
 
-def get_verifycode():
-    try:
-        result = subprocess.run(["./yukiverify"], encoding='utf-8', stdout=subprocess.PIPE)
-        hashed_password = result.stdout.strip()
-        return hashed_password
-    except subprocess.CalledProcessError as e:
-        print(f"Error: {e}")
-        return None
+# 書き込みごとにyukiverifyを起動しないよう、出力を有効な間だけ使い回す
+verifier = VerifyCodeProvider(
+    validity=float(os.environ.get("YUKI_VERIFY_TTL", "10")),  # 掲示板サーバーが受け付ける期間より短くする
+    timeout=float(os.environ.get("YUKI_VERIFY_TIMEOUT", "5")),
+    max_concurrency=int(os.environ.get("YUKI_VERIFY_CONCURRENCY", "2")),
+)
+
+async def get_verifycode():
+    return await verifier.get()
+
+# 書き込みと一緒に掲示板サーバーへ送るこのサーバーの情報
+def get_info(request):
+    return json.dumps([version, os.environ.get("RENDER_EXTERNAL_URL"), str(request.scope["headers"]), str(request.scope["router"])[39:-2]])
 
 
 
 
 
 from fastapi import FastAPI, Depends
-from fastapi import Response,Cookie,Request
+from fastapi import Response,Cookie,Request,Body
 from fastapi.responses import HTMLResponse,PlainTextResponse,StreamingResponse # StreamingResponseを追加
 from fastapi.responses import RedirectResponse as redirect
 from fastapi.middleware.gzip import GZipMiddleware
-from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel
-from typing import Union
+from typing import Union, List
 
 
 app = FastAPI(docs_url=None, redoc_url=None, openapi_url=None)
-app.mount("/css", StaticFiles(directory="./css"), name="static")
-app.mount("/word", StaticFiles(directory="./blog", html=True), name="static")
+# 静的ファイルは起動時に圧縮しておいたものを返す
+static_css = PrecompressedStaticFiles(directory="./css")
+static_word = PrecompressedStaticFiles(directory="./blog", html=True)
+app.mount("/css", static_css, name="static")
+app.mount("/word", static_word, name="static")
 app.add_middleware(GZipMiddleware, minimum_size=1000)
 
+
+class RouteTimer:
+    """ルートごとの処理時間をroute_secondsに記録するASGIミドルウェア。ストリーミングは送り終わるまでを測る。"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        start = time.time()
+        status = [500]
+
+        async def send_status(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_status)
+        finally:
+            route = scope.get("route")
+            route_seconds.observe(time.time() - start, route=getattr(route, "path", "unmatched"), method=scope["method"], status=str(status[0]))
+
+
+app.add_middleware(RouteTimer)
+
 from fastapi.templating import Jinja2Templates
-template = Jinja2Templates(directory='templates').TemplateResponse
+templates = Jinja2Templates(directory='templates')
+template = templates.TemplateResponse
+
+# 描画済みページのキャッシュ(ETag/304つき)
+pages = PageCache(
+    templates.env,
+    max_entries=int(os.environ.get("YUKI_PAGE_CACHE_ENTRIES", "512")),
+    max_bytes=int(os.environ.get("YUKI_PAGE_CACHE_BYTES", str(32 * 1024 * 1024))),
+)
+
+# keyは描画に使う引数やCookie、sourceは元のデータ。どちらも変わっていなければ描画し直さない
+def cached_page(request, name, key, source, context):
+    page = pages.render(name, key, source, {"request": request, **context})
+    return pages.response(page, request.headers)
 
 
 
@@ -250,133 +442,430 @@ template = Jinja2Templates(directory='templates').TemplateResponse
 
 
 @app.get("/", response_class=HTMLResponse)
-def home(response: Response,request: Request,yuki: Union[str] = Cookie(None)):
+async def home(response: Response,request: Request,yuki: Union[str] = Cookie(None)):
     if check_cokie(yuki):
         response.set_cookie("yuki","True",max_age=60 * 60 * 24 * 7)
         return template("home.html",{"request": request})
-    print(check_cokie(yuki))
     return redirect("/word")
 
 
 @app.get("/search", response_class=HTMLResponse,)
-def search(q:str,response: Response,request: Request,page:Union[int,None]=1,yuki: Union[str] = Cookie(None),proxy: Union[str] = Cookie(None)):
+async def search(q:str,response: Response,request: Request,page:Union[int,None]=1,yuki: Union[str] = Cookie(None),proxy: Union[str] = Cookie(None)):
     if not(check_cokie(yuki)):
         return redirect("/")
     response.set_cookie("yuki","True",max_age=60 * 60 * 24 * 7)
-    return template("search.html", {"request": request,"results":get_search(q,page),"word":q,"next":f"/search?q={q}&page={page + 1}","proxy":proxy})
+    results = await get_search(q,page)
+    prefetch_thumbnails(results)
+    prefetch_search(q,page + 1)
+    return cached_page(request, "search.html", ("search", q, page, proxy), results, {"results":results,"word":q,"next":f"/search?q={q}&page={page + 1}","proxy":proxy})
 
 @app.get("/hashtag/{tag}")
-def search(tag:str,response: Response,request: Request,page:Union[int,None]=1,yuki: Union[str] = Cookie(None)):
+async def search(tag:str,response: Response,request: Request,page:Union[int,None]=1,yuki: Union[str] = Cookie(None)):
     if not(check_cokie(yuki)):
         return redirect("/")
     return redirect(f"/search?q={tag}")
 
 
 @app.get("/channel/{channelid}", response_class=HTMLResponse)
-def channel(channelid:str,response: Response,request: Request,yuki: Union[str] = Cookie(None),proxy: Union[str] = Cookie(None)):
+async def channel(channelid:str,response: Response,request: Request,yuki: Union[str] = Cookie(None),proxy: Union[str] = Cookie(None)):
     if not(check_cokie(yuki)):
         return redirect("/")
     response.set_cookie("yuki","True",max_age=60 * 60 * 24 * 7)
-    t = get_channel(channelid)
-    return template("channel.html", {"request": request,"results":t[0],"channelname":t[1]["channelname"],"channelicon":t[1]["channelicon"],"channelprofile":t[1]["channelprofile"],"proxy":proxy})
+    t = await get_channel(channelid)
+    prefetch_thumbnails(t.videos)
+    return cached_page(request, "channel.html", (channelid, proxy), t, {"results":t.videos,"channelname":t.channelname,"channelicon":t.channelicon,"channelprofile":t.channelprofile,"proxy":proxy})
 
 @app.get("/answer", response_class=HTMLResponse)
-def set_cokie(q:str):
-    t = get_level(q)
-    if t > 5:
-        return f"level{t}\n推測を推奨する"
-    elif t == 0:
-        return "level12以上\nほぼ推測必須"
-    return f"level{t}\n覚えておきたいレベル"
+async def set_cokie(q:str):
+    return level_message(get_level(q))
+
+# 複数の単語をまとめて調べる。本文は単語のJSON配列
+@app.post("/answer/batch")
+async def answer_batch(words: List[str] = Body(...)):
+    return {word: {"level": t, "message": level_message(t)} for word, t in level_index.levels_of(words).items()}
 
 @app.get("/playlist", response_class=HTMLResponse)
-def playlist(list:str,response: Response,request: Request,page:Union[int,None]=1,yuki: Union[str] = Cookie(None),proxy: Union[str] = Cookie(None)):
+async def playlist(list:str,response: Response,request: Request,page:Union[int,None]=1,yuki: Union[str] = Cookie(None),proxy: Union[str] = Cookie(None)):
     if not(check_cokie(yuki)):
         return redirect("/")
     response.set_cookie("yuki","True",max_age=60 * 60 * 24 * 7)
-    return template("search.html", {"request": request,"results":get_playlist(list,str(page)),"word":"","next":f"/playlist?list={list}","proxy":proxy})
+    results = await get_playlist(list,str(page))
+    return cached_page(request, "search.html", ("playlist", list, page, proxy), results, {"results":results,"word":"","next":f"/playlist?list={list}","proxy":proxy})
 
 @app.get("/info", response_class=HTMLResponse)
-def viewlist(response: Response,request: Request,yuki: Union[str] = Cookie(None)):
-    global apis,apichannels,apicomments
+async def viewlist(response: Response,request: Request,yuki: Union[str] = Cookie(None)):
     if not(check_cokie(yuki)):
         return redirect("/")
     response.set_cookie("yuki","True",max_age=60 * 60 * 24 * 7)
-    return template("info.html",{"request": request,"Youtube_API":apis[0],"Channel_API":apichannels[0],"Comments_API":apicomments[0]})
+    ranking = {kind: health.snapshot(kind) for kind in ("video", "api", "channel", "comments")}
+    first = lambda kind: ranking[kind][0]["api"] if ranking[kind] else ""
+    return template("info.html",{"request": request,"Video_API":first("video"),"Youtube_API":first("api"),"Channel_API":first("channel"),"Comments_API":first("comments"),"ranking":ranking,"upstream_stats":upstream.stats()})
+
+async def fetch_suggestions(keyword):
+    res = await upstream.aget(r"http://www.google.com/complete/search?client=youtube&hl=ja&ds=yt&q="+urllib.parse.quote(keyword), timeout=max_api_wait_time)
+    if res.status_code != 200:
+        raise upstream.UpstreamStatusError(res.status_code)
+    return parse_jsonp(res.text)
+
+# 検索候補はプレフィックスごとにキャッシュし、よく打たれるものは裏で取り直しておく
+suggestions = SuggestionCache(
+    fetch_suggestions,
+    ttl=float(os.environ.get("YUKI_SUGGEST_TTL", "600")),
+    max_entries=int(os.environ.get("YUKI_SUGGEST_MAX_ENTRIES", "8192")),
+    hot_size=int(os.environ.get("YUKI_SUGGEST_HOT", "100")),  # 事前に取り直すプレフィックスの数。0なら取り直さない
+)
 
 @app.get("/suggest")
-def suggest(keyword:str):
-    return [i[0] for i in json.loads(requests.get(r"http://www.google.com/complete/search?client=youtube&hl=ja&ds=yt&q="+urllib.parse.quote(keyword)).text[19:-1])[1]]
+async def suggest(keyword:str):
+    return await suggestions.get(keyword)
 
 @app.get("/comments")
-def comments(request: Request,v:str):
-    return template("comments.html",{"request": request,"comments":get_comments(v)})
+async def comments(request: Request,v:str):
+    t = await get_comments(v)
+    return cached_page(request, "comments.html", (v,), t, {"comments":t})
 
 @app.get("/thumbnail")
-def thumbnail(v:str):
-    return Response(content = requests.get(fr"https://img.youtube.com/vi/{v}/0.jpg").content,media_type=r"image/jpeg")
+async def thumbnail(v:str,request: Request):
+    if not thumbnails.valid_id(v):
+        return Response(status_code=400)
+    try:
+        thumb = await thumbnails.get(v)
+    except upstream.UpstreamStatusError as e:
+        return Response(status_code=e.status_code)
+    except upstream.async_errors:
+        return Response(status_code=502)
+    if thumbnails.not_modified(thumb, request.headers):
+        return Response(status_code=304,headers=thumbnails.headers(thumb))
+    return Response(content=thumb.body,media_type=thumb.content_type,headers=thumbnails.headers(thumb))
 
 @app.get("/bbs",response_class=HTMLResponse)
-def view_bbs(request: Request,name: Union[str, None] = "",seed:Union[str,None]="",channel:Union[str,None]="main",verify:Union[str,None]="false",yuki: Union[str] = Cookie(None)):
+async def view_bbs(request: Request,name: Union[str, None] = "",seed:Union[str,None]="",channel:Union[str,None]="main",verify:Union[str,None]="false",yuki: Union[str] = Cookie(None)):
     if not(check_cokie(yuki)):
         return redirect("/")
-    res = HTMLResponse(requests.get(fr"{url}bbs?name={urllib.parse.quote(name)}&seed={urllib.parse.quote(seed)}&channel={urllib.parse.quote(channel)}&verify={urllib.parse.quote(verify)}",cookies={"yuki":"True"}).text)
+    res = HTMLResponse((await upstream.aget(fr"{bbs_url()}bbs?name={urllib.parse.quote(name)}&seed={urllib.parse.quote(seed)}&channel={urllib.parse.quote(channel)}&verify={urllib.parse.quote(verify)}",headers={"Cookie":"yuki=True"})).text)
     return res
 
-@cache(seconds=5)
-def bbsapi_cached(verify,channel):
-    return requests.get(fr"{url}bbs/api?t={urllib.parse.quote(str(int(time.time()*1000)))}&verify={urllib.parse.quote(verify)}&channel={urllib.parse.quote(channel)}",cookies={"yuki":"True"}).text
+async def fetch_bbsapi(verify,channel):
+    res = await upstream.aget(fr"{bbs_url()}bbs/api?t={urllib.parse.quote(str(int(time.time()*1000)))}&verify={urllib.parse.quote(verify)}&channel={urllib.parse.quote(channel)}",headers={"Cookie":"yuki=True"},timeout=max_api_wait_time)
+    if res.status_code != 200:
+        raise upstream.UpstreamStatusError(res.status_code)
+    return res.text
+
+# ポーリングしないチャンネルは、短い間だけ使い回して直接取りに行く
+@acache(seconds=5)
+async def fetch_bbsapi_cached(verify,channel):
+    return await fetch_bbsapi(verify,channel)
+
+def bbs_verify(verify):
+    # 掲示板サーバーが受け付けるのは"true"か"false"だけ
+    return "true" if str(verify).lower() == "true" else "false"
+
+# 掲示板の更新はチャンネルごとに1つの取得タスクから全員へ配る
+bbs_feeds = FeedHub(
+    fetch_bbsapi,
+    interval=float(os.environ.get("YUKI_BBS_POLL_INTERVAL", "1")),  # 掲示板サーバーを見に行く間隔(秒)
+    idle=float(os.environ.get("YUKI_BBS_FEED_IDLE", "60")),  # 誰も見なくなってから取得を止めるまで(秒)
+    channels=[c.strip() for c in os.environ.get("YUKI_BBS_CHANNELS", "main").split(",") if c.strip()],  # 取得タスクを動かすチャンネル
+)
+bbs_heartbeat = 15  # SSEで何もないときにコメント行を送る間隔(秒)
+bbs_poll_timeout = 25  # ロングポーリングで待つ最大時間(秒)
 
 @app.get("/bbs/api",response_class=HTMLResponse)
-def view_bbs(request: Request,t: str,channel:Union[str,None]="main",verify: Union[str,None] = "false"):
-    print(fr"{url}bbs/api?t={urllib.parse.quote(t)}&verify={urllib.parse.quote(verify)}&channel={urllib.parse.quote(channel)}")
-    return bbsapi_cached(verify,channel)
+async def view_bbs(request: Request,t: str,channel:Union[str,None]="main",verify: Union[str,None] = "false"):
+    verify = bbs_verify(verify)
+    try:
+        body = await bbs_feeds.feed(verify,channel).latest(max_api_wait_time)
+    except (KeyError, OverflowError):
+        body = await fetch_bbsapi_cached(verify,channel)
+    if body is None:
+        raise APItimeoutError("掲示板サーバーが応答しません")
+    return body
+
+# 更新をServer-Sent Eventsで受け取る(idは版数。再接続時はLast-Event-IDからの続き)
+@app.get("/bbs/stream")
+async def bbs_stream(request: Request,channel:Union[str,None]="main",verify: Union[str,None] = "false"):
+    try:
+        feed = bbs_feeds.feed(bbs_verify(verify),channel)
+    except KeyError:
+        return PlainTextResponse("unknown channel", status_code=404)
+    except OverflowError:
+        return PlainTextResponse("too many channels", status_code=503)
+    last = request.headers.get("last-event-id", "")
+    since = int(last) if last.isdigit() and int(last) <= feed.version else 0
+
+    async def events():
+        async for update in feed.stream(since, bbs_heartbeat):
+            if await request.is_disconnected():
+                break
+            if update is None:
+                yield ": ping\n\n"
+                continue
+            version, body = update
+            data = "\n".join("data: " + line for line in body.split("\n"))
+            yield f"id: {version}\nevent: update\n{data}\n\n"
+
+    # Content-Encodingを付けておくとGZipMiddlewareが溜め込まずにそのまま流す
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache", "Content-Encoding": "identity", "X-Accel-Buffering": "no"})
+
+# ロングポーリング版。sinceより新しい版ができるまで待ち、なければ204
+@app.get("/bbs/poll")
+async def bbs_poll(channel:Union[str,None]="main",verify: Union[str,None] = "false",since: int = 0):
+    try:
+        feed = bbs_feeds.feed(bbs_verify(verify),channel)
+    except KeyError:
+        return PlainTextResponse("unknown channel", status_code=404)
+    except OverflowError:
+        return PlainTextResponse("too many channels", status_code=503)
+    if since > feed.version:
+        since = 0
+    if not await feed.wait(since, bbs_poll_timeout):
+        return Response(status_code=204)
+    return {"version": feed.version, "body": feed.body}
 
 @app.get("/bbs/result")
-def write_bbs(request: Request,name: str = "",message: str = "",seed:Union[str,None] = "",channel:Union[str,None]="main",verify:Union[str,None]="false",yuki: Union[str] = Cookie(None)):
+async def write_bbs(request: Request,name: str = "",message: str = "",seed:Union[str,None] = "",channel:Union[str,None]="main",verify:Union[str,None]="false",yuki: Union[str] = Cookie(None)):
     if not(check_cokie(yuki)):
         return redirect("/")
-    t = requests.get(fr"{url}bbs/result?name={urllib.parse.quote(name)}&message={urllib.parse.quote(message)}&seed={urllib.parse.quote(seed)}&channel={urllib.parse.quote(channel)}&verify={urllib.parse.quote(verify)}&info={urllib.parse.quote(get_info(request))}&serververify={get_verifycode()}",cookies={"yuki":"True"}, allow_redirects=False)
+    verifycode = await get_verifycode()
+    t = await upstream.aget(fr"{bbs_url()}bbs/result?name={urllib.parse.quote(name)}&message={urllib.parse.quote(message)}&seed={urllib.parse.quote(seed)}&channel={urllib.parse.quote(channel)}&verify={urllib.parse.quote(verify)}&info={urllib.parse.quote(get_info(request))}&serververify={verifycode}",headers={"Cookie":"yuki=True"},allow_redirects=False)
     if t.status_code != 307:
         return HTMLResponse(t.text)
     return redirect(f"/bbs?name={urllib.parse.quote(name)}&seed={urllib.parse.quote(seed)}&channel={urllib.parse.quote(channel)}&verify={urllib.parse.quote(verify)}")
 
-@cache(seconds=30)
-def how_cached():
-    return requests.get(fr"{url}bbs/how").text
+@acache(seconds=30, stale=300)
+async def how_cached():
+    return (await upstream.aget(fr"{bbs_url()}bbs/how")).text
 
 @app.get("/bbs/how",response_class=PlainTextResponse)
-def view_commonds(request: Request,yuki: Union[str] = Cookie(None)):
+async def view_commonds(request: Request,yuki: Union[str] = Cookie(None)):
     if not(check_cokie(yuki)):
         return redirect("/")
-    return how_cached()
+    return await how_cached()
 
 @app.get("/load_instance")
-def home():
-    global url
-    url = "https://yukibbs-server.onrender.com/"
+async def home():
+    await asyncio.to_thread(set_bbs_url, bbs_default_url)
+
+
+async def refresh_api_list():
+    """リモートのAPI一覧を取り直してレジストリへ反映する。他のワーカーが最近取り直していればそれを使う。"""
+    apis = await asyncio.to_thread(shared.get_config, "api_list", max_age=api_list_refresh)
+    if apis is None:
+        res = await upstream.aget(api_list_url, timeout=max_api_wait_time)
+        if res.status_code != 200:
+            raise upstream.UpstreamStatusError(res.status_code)
+        apis = parse_api_list(res.text)
+        await asyncio.to_thread(shared.set_config, "api_list", apis)
+    health.set_instances(apis)
+
+
+def sync_shared():
+    # 裏のスレッドから呼ぶ
+    global bbs_current
+    try:
+        health.sync()
+        bbs_current = shared.get_config("bbs_url", bbs_default_url)
+    except shared_state.errors as e:
+        logs.warning("インスタンスの状態を共有DBと合わせられませんでした", error=str(e))
+
+
+async def shared_syncer():
+    while True:
+        await asyncio.sleep(shared_sync_interval)
+        await asyncio.to_thread(sync_shared)
+
+
+async def shared_cache_pruner():
+    # 共有DBのキャッシュの容量の整理はリクエストの外で行う
+    while True:
+        await asyncio.sleep(10)
+        await asyncio.to_thread(response_disk.prune)
+
+
+async def api_list_refresher():
+    # 起動を待たせないよう、一覧の取得は起動後に裏で定期的に行う
+    while True:
+        try:
+            await refresh_api_list()
+        except (*upstream.async_errors, *shared_state.errors, upstream.UpstreamStatusError, ValueError, SyntaxError) as e:
+            logs.warning("API一覧の更新に失敗しました", error=type(e).__name__)
+        await asyncio.sleep(api_list_refresh)
+
+
+api_list_task = None
+suggest_task = None
+shared_task = None
+prune_task = None
+level_task = None
+
+
+@app.on_event("startup")
+async def start_api_list_refresher():
+    global api_list_task, suggest_task, shared_task, prune_task, level_task
+    if api_list_refresh > 0:
+        api_list_task = asyncio.ensure_future(api_list_refresher())
+    if suggestions.hot_size > 0:
+        suggest_task = asyncio.ensure_future(suggestions.run_precompute())
+    if health.store is not None and shared_sync_interval > 0:
+        shared_task = asyncio.ensure_future(shared_syncer())
+    if isinstance(response_disk, SharedCacheTier):
+        prune_task = asyncio.ensure_future(shared_cache_pruner())
+    # 単語レベルの索引と静的ファイルの圧縮はリクエストを受け付ける前に一度だけ済ませる
+    await asyncio.to_thread(level_index.reload)
+    if level_index.check_interval > 0:
+        level_task = asyncio.ensure_future(level_index.run_refresh())
+    await asyncio.to_thread(static_css.precompress)
+    await asyncio.to_thread(static_word.precompress)
+
+
+@registry.collector
+def cache_metrics():
+    caches = {"response": response_cache.stats(), "thumbnail": thumbnails.stats(), "bbs_how": how_cached.cache_info(), "page": pages.stats()}
+    if segments is not None:
+        caches["segment"] = segments.stats()
+    gauges = ("entries", "bytes", "max_entries", "max_bytes", "memory_entries", "memory_bytes", "segments")
+    events, sizes, ratios = [], [], []
+    for name, stats in caches.items():
+        for key, value in stats.items():
+            if value is None or key == "hit_rate":
+                continue
+            if key in gauges:
+                sizes.append(({"cache": name, "stat": key}, value))
+            else:
+                events.append(({"cache": name, "event": key}, value))
+        if "hit_rate" in stats:
+            ratios.append(({"cache": name}, stats["hit_rate"]))
+    thumb = caches["thumbnail"]
+    looked = thumb["memory_hits"] + thumb["disk_hits"] + thumb["misses"]
+    ratios.append(({"cache": "thumbnail"}, (thumb["memory_hits"] + thumb["disk_hits"]) / looked if looked else 0.0))
+    if segments is not None:
+        # セグメントキャッシュはバイト数で見たヒット率
+        served = caches["segment"]["hit_bytes"] + caches["segment"]["origin_bytes"]
+        ratios.append(({"cache": "segment"}, caches["segment"]["hit_bytes"] / served if served else 0.0))
+    return [
+        ("yuki_cache_events_total", "counter", "Cache events (hits, misses, evictions, ...) by cache.", events),
+        ("yuki_cache_size", "gauge", "Current and maximum cache sizes.", sizes),
+        ("yuki_cache_hit_ratio", "gauge", "Fraction of lookups served from the cache.", ratios),
+    ]
+
+
+@registry.collector
+def instance_metrics():
+    latency, success, circuit = [], [], []
+    for kind in ("video", "api", "channel", "comments"):
+        for row in health.snapshot(kind):
+            labels = {"kind": kind, "instance": row["api"]}
+            if row["latency"] is not None:
+                latency.append((labels, row["latency"]))
+                success.append((labels, row["success_rate"]))
+            if kind == "api":
+                # サーキットはインスタンス単位なので1回だけ出す
+                circuit.append(({"instance": row["api"], "state": row["state"]}, 1))
+    return [
+        ("yuki_instance_latency_ewma_seconds", "gauge", "Smoothed latency of an instance.", latency),
+        ("yuki_instance_success_rate", "gauge", "Smoothed success rate of an instance.", success),
+        ("yuki_instance_circuit", "gauge", "Circuit breaker state of an instance.", circuit),
+    ]
+
+
+@registry.collector
+def pool_metrics():
+    rows = {"requests": [], "errors": [], "idle_connections": [], "active_connections": []}
+    for host, stats in upstream.stats().items():
+        for key, samples in rows.items():
+            if key in stats:
+                samples.append(({"host": host}, stats[key]))
+    return [
+        ("yuki_pool_requests_total", "counter", "Requests sent through the shared HTTP clients, by host.", rows["requests"]),
+        ("yuki_pool_errors_total", "counter", "Requests that failed to connect or read, by host.", rows["errors"]),
+        ("yuki_pool_idle_connections", "gauge", "Idle keep-alive connections, by host.", rows["idle_connections"]),
+        ("yuki_pool_active_connections", "gauge", "Connections in use, by host.", rows["active_connections"]),
+    ]
+
+
+@registry.collector
+def verifier_metrics():
+    return [("yuki_verifier_events_total", "counter", "yukiverify runs, failures, timeouts and reused codes.", [({"event": key}, value) for key, value in verifier.stats().items()])]
+
+
+@registry.collector
+def bbs_metrics():
+    stats = bbs_feeds.stats()
+    return [
+        ("yuki_bbs_feeds", "gauge", "Channels with a running BBS poller.", [({}, stats["feeds"])]),
+        ("yuki_bbs_subscribers", "gauge", "Clients connected over SSE.", [({}, stats["subscribers"])]),
+        ("yuki_bbs_polls_total", "counter", "Requests made to the BBS server by the pollers.", [({}, stats["polls"])]),
+    ]
+
+
+@registry.collector
+def suggest_metrics():
+    stats = suggestions.stats()
+    return [
+        ("yuki_suggest_events_total", "counter", "Suggestion lookups by how they were answered.", [({"event": key}, stats[key]) for key in ("requests", "hits", "stale_hits", "prefix_reuse", "coalesced", "misses", "precomputed", "upstream")]),
+        ("yuki_suggest_hit_ratio", "gauge", "Fraction of suggestion lookups answered without waiting on upstream.", [({}, stats["hit_rate"])]),
+    ]
+
+
+@registry.collector
+def prefetch_metrics():
+    events, seconds, ratios = [], [], []
+    for kind, stats in prefetcher.stats().items():
+        for key in ("scheduled", "started", "completed", "failed", "dropped", "cancelled", "used"):
+            events.append(({"kind": kind, "event": key}, stats[key]))
+        seconds.append(({"kind": kind, "type": "saved"}, stats["saved_seconds"]))
+        seconds.append(({"kind": kind, "type": "upstream"}, stats["upstream_seconds"]))
+        ratios.append(({"kind": kind}, stats["hit_rate"]))
+    return [
+        ("yuki_prefetch_events_total", "counter", "Prefetch jobs by outcome; used means a real request was served by it.", events),
+        ("yuki_prefetch_seconds_total", "counter", "Upstream time spent on prefetches, and client wait time they saved.", seconds),
+        ("yuki_prefetch_hit_ratio", "gauge", "Fraction of completed prefetches that a real request used.", ratios),
+        ("yuki_prefetch_queue", "gauge", "Prefetch jobs waiting or running.", [({"state": "queued"}, prefetcher.queued), ({"state": "running"}, prefetcher.running)]),
+    ]
+
+
+@registry.collector
+def shared_metrics():
+    if not shared.persistent:
+        return []
+    return [
+        ("yuki_shared_state_size", "gauge", "Size of the shared state database and the responses cached in it.", [({"stat": key}, value) for key, value in shared.stats().items()]),
+        ("yuki_shared_pending_records", "gauge", "Instance health records not yet written to the shared state database.", [({}, health.pending)]),
+    ]
+
+
+@app.get("/metrics")
+async def metrics_endpoint():
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
+
+
+@app.on_event("shutdown")
+async def close_upstream():
+    for task in (api_list_task, suggest_task, shared_task, prune_task, level_task):
+        if task is not None:
+            task.cancel()
+    bbs_feeds.close()
+    prefetcher.close()
+    await asyncio.to_thread(sync_shared)
+    await upstream.aclose()
 
 
 @app.exception_handler(500)
-def page(request: Request,__):
+async def page(request: Request,__):
     return template("APIwait.html",{"request": request},status_code=500)
 
 @app.exception_handler(APItimeoutError)
-def APIwait(request: Request,exception: APItimeoutError):
+async def APIwait(request: Request,exception: APItimeoutError):
     return template("APIwait.html",{"request": request},status_code=500)
 
-g_videoid = None
-
 @app.get('/watch', response_class=HTMLResponse)
-def video(
+async def video(
     v: str, 
     response: Response, 
     request: Request, 
     yuki: Union[str] = Cookie(None), 
     proxy: Union[str] = Cookie(None)
 ):
-    global g_videoid  # グローバル変数を使用するために宣言
-
     # クッキーの確認
     if not check_cokie(yuki):
         return redirect("/")
@@ -384,41 +873,43 @@ def video(
     # クッキーをセット
     response.set_cookie(key="yuki", value="True", max_age=7*24*60*60)
 
-    # 動画IDを取得し、videoidとg_videoidに代入
+    # 動画IDはこのリクエストの中だけで使う(同時に来た別のリクエストと混ざらないようグローバルには置かない)
     videoid = v
-    g_videoid = videoid  # グローバル変数に代入
 
     # データを取得
-    t = get_data(videoid)
+    t = await get_data(videoid)
+
+    # このあとブラウザが読みに来るコメントと、次に開かれそうな関連動画を先読みする
+    prefetch_comments(videoid)
+    for related in t.related[:prefetch_related]:
+        prefetch_data(related.id)
 
     # 再度クッキーをセット
     response.set_cookie(key="yuki", value="True", max_age=60 * 60 * 24 * 7)
 
-    # テンプレートに g_videoid を渡す
-    return template('video.html', {
-        "request": request,
+    return cached_page(request, 'video.html', (videoid, proxy), t, {
         "videoid": videoid,
-        "g_videoid": g_videoid,  # ここで g_videoid をテンプレートに渡す
-        "videourls": t[1],
-        "res": t[0],
-        "description": t[2],
-        "videotitle": t[3],
-        "authorid": t[4],
-        "authoricon": t[6],
-        "author": t[5],
+        "videourls": t.videourls,
+        "res": t.related,
+        "description": t.description,
+        "videotitle": t.title,
+        "authorid": t.authorId,
+        "authoricon": t.authoricon,
+        "author": t.author,
         "proxy": proxy
     })
-    @app.get("/umekomi")
-def umekomi_proxy(url: str, request: Request):
+
+@app.get("/umekomi")
+async def umekomi_proxy(url: str, request: Request):
     """
     HTTP Rangeリクエストに透過的に対応し、シーク可能な動画ストリーミングを可能にするプロキシ。
     """
     if not url:
-        print("Proxy Error: URL parameter is empty.")
+        logs.info("Proxy Error: URL parameter is empty.")
         return Response(content="Error: 'url' parameter is required.", status_code=400, media_type="text/plain")
 
     # 1. クライアントから受け取ったヘッダーを抽出
-    # Host, Accept-Encoding, Content-LengthなどはRequestsに任せ、または除外します。
+    # Host, Accept-Encoding, Content-Lengthなどはaiohttpに任せ、または除外します。
     # Rangeヘッダーはプロキシ先のサーバーに転送するため、そのまま残します。
     proxied_headers = {
         k: v for k, v in request.headers.items() 
@@ -428,46 +919,70 @@ def umekomi_proxy(url: str, request: Request):
     # User-Agentを上書きして、一般的なブラウザからのリクエストに見せかける
     proxied_headers['User-Agent'] = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
 
-    try:
-        # 2. プロキシ先へのリクエスト実行
-        res = requests.get(url, stream=True, timeout=30, headers=proxied_headers)
-        res.raise_for_status() # 4xx/5xxエラーの場合はrequests.exceptions.HTTPErrorを発生させる
-
-        # 3. クライアントに戻すヘッダーを構築
-        final_headers = {}
-        # 動画ストリーミングで重要なヘッダー（特にRange関連）をすべて転送
-        for k, v in res.headers.items():
-            # Connectionヘッダーは自動的にrequestsが処理するため除外
-            if k.lower() not in ('transfer-encoding', 'connection'):
-                final_headers[k] = v
-
-        # Rangeリクエストが成功した場合、ステータスコードは 206 Partial Content です。
-        # フルリクエストの場合は 200 OK です。これらをプロキシ先から受け取ったものをそのまま使用します。
-        status_code = res.status_code
-        
-        # 4. 最終的なStreamingResponseを返す
-        return StreamingResponse(
-            content=res.iter_content(chunk_size=8192), 
-            status_code=status_code, 
-            headers=final_headers,
-            media_type=final_headers.get('Content-Type', 'application/octet-stream')
+    def connection_failed(e):
+        # 接続、タイムアウトなど、その他のリクエストエラー
+        logs.warning("Proxy connection failed (Network/Timeout)", url=url, error=type(e).__name__, details=str(e))
+        return Response(
+            content=f"Proxy Error: Connection/Timeout Failed for {url}", 
+            status_code=502, 
+            media_type="text/plain"
         )
 
-    except requests.exceptions.HTTPError as e:
+    def target_error(status_code):
         # プロキシ先がHTTPエラーを返した場合 (403 Forbidden, 404 Not Found など)
-        status_code = e.response.status_code
-        print(f"Proxy target returned HTTP Error: {status_code} for {url}. Details: {e}")
+        logs.info("Proxy target returned HTTP Error", url=url, status=status_code)
         return Response(
             content=f"Proxy Target Error: Status {status_code}", 
             status_code=status_code, 
             media_type="text/plain"
         )
-        
-    except requests.exceptions.RequestException as e:
-        # 接続、タイムアウトなど、その他のリクエストエラー
-        print(f"Proxy connection failed (Network/Timeout) to {url}. Error type: {type(e).__name__}. Details: {e}")
-        return Response(
-            content=f"Proxy Error: Connection/Timeout Failed for {url}", 
-            status_code=502, 
-            media_type="text/plain"
-        )
+
+    # 2. セグメントキャッシュで組み立てられる範囲ならキャッシュから返す(足りない分だけ上流へ取りに行く)
+    if segments is not None:
+        origin_headers = {k: v for k, v in proxied_headers.items() if k.lower() != 'range'}
+        try:
+            cached = await segments.open(url, request.headers.get('range'), origin_headers)
+        except OriginError as e:
+            return target_error(e.status_code)
+        except upstream.async_errors as e:
+            return connection_failed(e)
+        if cached is not None:
+            status_code, headers, body = cached
+            if body is None:
+                return Response(status_code=status_code, headers=headers)
+            return StreamingResponse(content=body, status_code=status_code, headers=headers, media_type=headers["Content-Type"])
+
+    try:
+        # プロキシ先へのリクエスト実行(ボディはまだ読まない)
+        res = await upstream.aget(url, stream=True, timeout=30, headers=proxied_headers)
+    except upstream.async_errors as e:
+        return connection_failed(e)
+
+    if res.status_code >= 400:
+        await res.aclose()
+        return target_error(res.status_code)
+
+    # 3. クライアントに戻すヘッダーを構築
+    final_headers = {}
+    # 動画ストリーミングで重要なヘッダー（特にRange関連）をすべて転送
+    for k, v in res.headers.items():
+        # 転送時に付け直されるヘッダーは除外
+        if k.lower() not in ('transfer-encoding', 'connection'):
+            final_headers[k] = v
+
+    # 送り終わるか切断されたらコネクションをプールへ返す
+    async def body():
+        try:
+            async for chunk in adaptive_chunks(res):
+                yield chunk
+        finally:
+            await res.aclose()
+
+    # 4. 最終的なStreamingResponseを返す
+    # Rangeリクエストが成功した場合は 206、フルリクエストの場合は 200 をそのまま返します。
+    return StreamingResponse(
+        content=body(), 
+        status_code=res.status_code, 
+        headers=final_headers,
+        media_type=final_headers.get('Content-Type', 'application/octet-stream')
+    )
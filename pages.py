@@ -0,0 +1,172 @@
+import gzip
+import hashlib
+import os
+
+from starlette.datastructures import Headers
+from starlette.responses import FileResponse, Response
+from starlette.staticfiles import StaticFiles
+
+from cache import TTLCache
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# 描画済みページと静的ファイルの圧縮済みキャッシュ
+# ページは描画に使ったもの(ルートの引数・Cookie)をキーに、元データ(response_cacheのレコード)が同じ間だけ使い回す。
+# 本文から強いETagを作って304を返し、gzip/brotliに圧縮したものも一度作ったら取っておく。
+# /css・/wordのファイルは起動時にまとめて圧縮しておき、Accept-Encodingを見て選んで返す。
+
+compressible = (".css", ".js", ".html", ".htm", ".svg", ".txt", ".json", ".xml", ".map")
+
+
+def accepted_encodings(headers):
+    """Accept-Encodingのうちq=0でないもの。"""
+    accepted = set()
+    for part in headers.get("accept-encoding", "").split(","):
+        name, _, params = part.strip().partition(";")
+        q = params.strip()
+        if q.startswith("q="):
+            try:
+                if float(q[2:]) <= 0:
+                    continue
+            except ValueError:
+                continue
+        if name:
+            accepted.add(name.strip().lower())
+    return accepted
+
+
+def choose_encoding(headers, available):
+    accepted = accepted_encodings(headers)
+    for encoding in ("br", "gzip"):
+        if encoding in available and (encoding in accepted or "*" in accepted):
+            return encoding
+    return None
+
+
+def compress(data, encoding, best=False):
+    # 静的ファイルは起動時に一度だけなので最高圧縮。ページは描画のたびなので速い設定にする
+    if encoding == "br":
+        return brotli.compress(data, quality=11 if best else 5)
+    return gzip.compress(data, compresslevel=9 if best else 6, mtime=0)
+
+
+def etag_matches(etag, headers):
+    if_none_match = headers.get("if-none-match")
+    if if_none_match is None:
+        return False
+    return if_none_match.strip() == "*" or etag in [tag.strip() for tag in if_none_match.split(",")]
+
+
+class Page:
+    __slots__ = ("body", "digest", "encoded", "key")
+
+    def __init__(self, body, key=None):
+        self.body = body
+        self.digest = hashlib.sha1(body).hexdigest()
+        self.encoded = {}
+        self.key = key  # PageCacheでのキー
+
+    def etag(self, encoding=None):
+        # 圧縮したものは中身のバイト列が違うので別のETagにする
+        return f'"{self.digest}-{encoding}"' if encoding else f'"{self.digest}"'
+
+    def size(self):
+        return len(self.body) + sum(len(v) for v in self.encoded.values())
+
+
+class PageCache:
+    def __init__(self, environment, ttl=600, max_entries=512, max_bytes=32 * 1024 * 1024, minimum_size=500):
+        self.environment = environment
+        self.minimum_size = minimum_size
+        self._pages = TTLCache(ttl, max_entries=max_entries, max_bytes=max_bytes, sizeof=lambda entry: entry[1].size())
+        self._counters = {"hits": 0, "renders": 0, "not_modified": 0}
+
+    def render(self, name, key, source, context):
+        """keyとsourceが前回と同じなら描画済みのPageを返す。sourceは同一オブジェクトかどうかで比べる。"""
+        key = (name,) + tuple(key)
+        cached = self._pages.get(key)
+        if cached is not None and cached[0] is source:
+            self._counters["hits"] += 1
+            return cached[1]
+        self._counters["renders"] += 1
+        page = Page(self.environment.get_template(name).render(context).encode("utf-8"), key)
+        # 元データを参照しておくことで、別のオブジェクトが同じidを使い回すことはない
+        self._pages.set(key, (source, page))
+        return page
+
+    def response(self, page, request_headers, status_code=200):
+        encoding = choose_encoding(request_headers, ("br", "gzip") if brotli is not None else ("gzip",)) if len(page.body) >= self.minimum_size else None
+        headers = {"ETag": page.etag(encoding), "Vary": "Accept-Encoding", "Cache-Control": "private, no-cache"}
+        if etag_matches(headers["ETag"], request_headers):
+            self._counters["not_modified"] += 1
+            return Response(status_code=304, headers=headers)
+        body = page.body
+        if encoding is not None:
+            body = page.encoded.get(encoding)
+            if body is None:
+                body = page.encoded[encoding] = compress(page.body, encoding)
+                if page.key is not None:
+                    # 圧縮したものの分も大きさに数え直す
+                    self._pages.resize(page.key)
+            # Content-Encodingが付いているのでGZipMiddlewareはそのまま通す
+            headers["Content-Encoding"] = encoding
+        return Response(body, status_code=status_code, media_type="text/html; charset=utf-8", headers=headers)
+
+    def stats(self):
+        stats = dict(self._counters)
+        cached = self._pages.stats()
+        stats["hit_rate"] = stats["hits"] / (stats["hits"] + stats["renders"]) if stats["renders"] else 0.0
+        stats["entries"] = cached["entries"]
+        stats["bytes"] = cached["bytes"]
+        return stats
+
+
+class PrecompressedStaticFiles(StaticFiles):
+    """StaticFilesに、起動時に圧縮しておいたgzip/brotli版を返す機能を足したもの。"""
+
+    def __init__(self, *args, minimum_size=500, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.minimum_size = minimum_size
+        self._variants = {}  # 実際のパス -> (mtime_ns, size, digest, {encoding: bytes})
+
+    def precompress(self):
+        encodings = ("br", "gzip") if brotli is not None else ("gzip",)
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                if not name.lower().endswith(compressible):
+                    continue
+                path = os.path.realpath(os.path.join(root, name))
+                try:
+                    st = os.stat(path)
+                    with open(path, "rb") as f:
+                        data = f.read()
+                except OSError:
+                    continue
+                if len(data) < self.minimum_size:
+                    continue
+                self._variants[path] = (st.st_mtime_ns, st.st_size, hashlib.sha1(data).hexdigest(), {encoding: compress(data, encoding, best=True) for encoding in encodings})
+
+    async def get_response(self, path, scope):
+        response = await super().get_response(path, scope)
+        if not isinstance(response, FileResponse) or response.status_code != 200:
+            return response
+        entry = self._variants.get(os.path.realpath(response.path))
+        if entry is None:
+            return response
+        mtime_ns, size, digest, variants = entry
+        st = response.stat_result
+        if st is None or st.st_mtime_ns != mtime_ns or st.st_size != size:
+            # 起動後に書き換えられたファイルはそのまま返す
+            return response
+        request_headers = Headers(scope=scope)
+        encoding = choose_encoding(request_headers, variants)
+        if encoding is None:
+            return response
+        headers = {"ETag": f'"{digest}-{encoding}"', "Vary": "Accept-Encoding", "Last-Modified": response.headers["last-modified"]}
+        if etag_matches(headers["ETag"], request_headers):
+            return Response(status_code=304, headers=headers)
+        headers["Content-Encoding"] = encoding
+        return Response(variants[encoding], media_type=response.media_type, headers=headers)
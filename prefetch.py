@@ -0,0 +1,152 @@
+import asyncio
+import heapq
+import itertools
+import time
+from collections import OrderedDict
+
+import logs
+
+# 次に来そうなリクエスト(動画を開いた後のコメント、検索の次のページ、関連動画)を裏で先に取っておくスケジューラ
+# 優先度付きのキューから同時にconcurrency件まで実行し、キューがmax_queueを超えたら優先度の低いものから捨てる。
+# 本物のリクエストが先に来たらキューにあるものは取り消す。
+# 先に取ったものが実際に使われたか(used)と、それで省けた待ち時間(saved_seconds)を種類ごとに数える。
+
+
+class _Job:
+    __slots__ = ("priority", "seq", "key", "kind", "load", "queued", "cancelled")
+
+    def __init__(self, priority, seq, key, kind, load):
+        self.priority = priority
+        self.seq = seq
+        self.key = key
+        self.kind = kind
+        self.load = load
+        self.queued = time.time()
+        self.cancelled = False
+
+    def __lt__(self, other):
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+class PrefetchScheduler:
+    def __init__(self, concurrency=4, max_queue=256, max_wait=30, remember=4096):
+        self.concurrency = concurrency
+        self.max_queue = max_queue
+        self.max_wait = max_wait  # これより長くキューで待ったものはもう要らないとみなす
+        self.remember = remember
+        self._heap = []
+        self._queued = {}
+        self._running = {}
+        self._done = OrderedDict()  # key -> (kind, 取得に掛かった秒数)
+        self._claimed = {}  # 先読み中に本物のリクエストが来たkey -> その時刻
+        self._seq = itertools.count()
+        self._counters = {}
+
+    def _count(self, kind, event, value=1):
+        counters = self._counters.setdefault(kind, dict.fromkeys(("scheduled", "started", "completed", "failed", "dropped", "cancelled", "used", "saved_seconds", "upstream_seconds"), 0))
+        counters[event] += value
+
+    def schedule(self, key, kind, load, priority=0):
+        """load()(awaitableを返す)を裏で実行する予約をする。priorityは小さいほど先。"""
+        if self.concurrency <= 0 or key in self._queued or key in self._running:
+            return
+        # 前に取ったものは使われずに期限が切れたので取り直す
+        self._done.pop(key, None)
+        job = _Job(priority, next(self._seq), key, kind, load)
+        self._queued[key] = job
+        heapq.heappush(self._heap, job)
+        self._count(kind, "scheduled")
+        if len(self._queued) > self.max_queue:
+            worst = max(self._queued.values())
+            self._discard(worst, "dropped")
+        self._pump()
+
+    def _discard(self, job, event):
+        job.cancelled = True
+        del self._queued[job.key]
+        self._count(job.kind, event)
+
+    def _pump(self):
+        now = time.time()
+        while self._heap and len(self._running) < self.concurrency:
+            job = heapq.heappop(self._heap)
+            if job.cancelled:
+                continue
+            if now - job.queued > self.max_wait:
+                self._discard(job, "dropped")
+                continue
+            del self._queued[job.key]
+            self._count(job.kind, "started")
+            task = self._running[job.key] = asyncio.ensure_future(self._run(job))
+            task.add_done_callback(lambda _, key=job.key: self._finished(key))
+
+    async def _run(self, job):
+        start = time.time()
+        try:
+            await job.load()
+        except Exception as e:
+            self._count(job.kind, "failed")
+            logs.debug("先読みに失敗しました", kind=job.kind, key=job.key, error=type(e).__name__)
+            return
+        finally:
+            claimed = self._claimed.pop(job.key, None)
+        seconds = time.time() - start
+        self._count(job.kind, "completed")
+        self._count(job.kind, "upstream_seconds", seconds)
+        if claimed is not None:
+            # 途中から相乗りされた分だけ待ち時間が減った
+            self._count(job.kind, "used")
+            self._count(job.kind, "saved_seconds", claimed - start)
+            return
+        self._done[job.key] = (job.kind, seconds)
+        while len(self._done) > self.remember:
+            self._done.popitem(last=False)
+
+    def _finished(self, key):
+        self._running.pop(key, None)
+        self._pump()
+
+    def claim(self, key, cached=True):
+        """本物のリクエストが来たときに呼ぶ。キューにあれば取り消し、先に取ってあってまだcachedなら使われたと数える。"""
+        job = self._queued.get(key)
+        if job is not None:
+            self._discard(job, "cancelled")
+            return
+        if key in self._running:
+            self._claimed.setdefault(key, time.time())
+            return
+        done = self._done.pop(key, None)
+        if done is not None and cached:
+            kind, seconds = done
+            self._count(kind, "used")
+            self._count(kind, "saved_seconds", seconds)
+
+    def cancel(self, key):
+        job = self._queued.get(key)
+        if job is not None:
+            self._discard(job, "cancelled")
+        task = self._running.get(key)
+        if task is not None:
+            task.cancel()
+
+    def close(self):
+        for job in list(self._queued.values()):
+            self._discard(job, "cancelled")
+        for task in list(self._running.values()):
+            task.cancel()
+
+    def stats(self):
+        stats = {}
+        for kind, counters in self._counters.items():
+            row = dict(counters)
+            row["hit_rate"] = row["used"] / row["completed"] if row["completed"] else 0.0
+            stats[kind] = row
+        return stats
+
+    @property
+    def queued(self):
+        return len(self._queued)
+
+    @property
+    def running(self):
+        return len(self._running)
@@ -0,0 +1,215 @@
+import datetime
+import json
+import sys
+import urllib.parse
+
+# Invidiousの応答の読み込み
+# JSONは1回だけ解析し(orjsonが入っていればそちらを使う)、画面ごとに必要な項目だけを
+# __slots__のレコードに写して持つ。キャッシュにもこのレコードを入れるので、巨大な元のdictは残らない。
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+backend = "orjson" if orjson is not None else "json"
+
+
+def loads(data):
+    """str/bytesのJSONを解析する。壊れていればValueError。"""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+class Record:
+    """テンプレートや既存のコードからはdictと同じようにrecord["title"]で読める。"""
+    __slots__ = ()
+
+    def __getitem__(self, name):
+        try:
+            return getattr(self, name)
+        except AttributeError:
+            raise KeyError(name) from None
+
+    def get(self, name, default=None):
+        return getattr(self, name, default)
+
+    def __repr__(self):
+        return f"{type(self).__name__}({', '.join(f'{k}={getattr(self, k)!r}' for k in self.__slots__)})"
+
+
+class VideoCard(Record):
+    __slots__ = ("type", "id", "title", "authorId", "author", "length", "published", "viewCount")
+
+    def __init__(self, id, title, authorId, author, length=None, published=None, viewCount=None):
+        self.type = "video"
+        self.id = id
+        self.title = title
+        self.authorId = authorId
+        self.author = author
+        self.length = length
+        self.published = published
+        self.viewCount = viewCount
+
+
+class PlaylistCard(Record):
+    __slots__ = ("type", "id", "title", "thumbnail", "count")
+
+    def __init__(self, id, title, thumbnail, count):
+        self.type = "playlist"
+        self.id = id
+        self.title = title
+        self.thumbnail = thumbnail
+        self.count = count
+
+
+class ChannelCard(Record):
+    __slots__ = ("type", "id", "author", "thumbnail")
+
+    def __init__(self, id, author, thumbnail):
+        self.type = "channel"
+        self.id = id
+        self.author = author
+        self.thumbnail = thumbnail
+
+
+class Comment(Record):
+    __slots__ = ("author", "authoricon", "authorid", "body")
+
+    def __init__(self, author, authoricon, authorid, body):
+        self.author = author
+        self.authoricon = authoricon
+        self.authorid = authorid
+        self.body = body
+
+
+class Channel(Record):
+    __slots__ = ("videos", "channelname", "channelicon", "channelprofile")
+
+    def __init__(self, videos, channelname, channelicon, channelprofile):
+        self.videos = videos
+        self.channelname = channelname
+        self.channelicon = channelicon
+        self.channelprofile = channelprofile
+
+
+class Video(Record):
+    __slots__ = ("related", "videourls", "description", "title", "authorId", "author", "authoricon", "expire")
+
+    def __init__(self, related, videourls, description, title, authorId, author, authoricon, expire):
+        self.related = related
+        self.videourls = videourls
+        self.description = description
+        self.title = title
+        self.authorId = authorId
+        self.author = author
+        self.authoricon = authoricon
+        self.expire = expire
+
+
+# 画面ごとの写し方
+
+def _stream_expire(urls):
+    # ストリームURLのうち一番早く切れるexpire(UNIX時刻)。無ければNone
+    expires = []
+    for url in urls:
+        expire = urllib.parse.parse_qs(urllib.parse.urlsplit(url).query).get("expire")
+        if expire and expire[0].isdigit():
+            expires.append(int(expire[0]))
+    return min(expires) if expires else None
+
+
+def video(data):
+    t = loads(data)
+    streams = [i["url"] for i in t["formatStreams"]]
+    related = [VideoCard(i["videoId"], i["title"], i["authorId"], i["author"], viewCount=i.get("viewCount", 0)) for i in t["recommendedVideos"]]
+    return Video(
+        related,
+        list(reversed(streams))[:2],  # 逆順で2つのストリームURL
+        t["descriptionHtml"].replace("\n", "<br>"),
+        t["title"],
+        t["authorId"],
+        t["author"],
+        t["authorThumbnails"][-1]["url"],
+        _stream_expire(streams),
+    )
+
+
+def _search_item(i):
+    if i["type"] == "video":
+        return VideoCard(i["videoId"], i["title"], i["authorId"], i["author"], str(datetime.timedelta(seconds=i["lengthSeconds"])), i["publishedText"])
+    if i["type"] == "playlist":
+        return PlaylistCard(i["playlistId"], i["title"], i["videos"][0]["videoId"], i["videoCount"])
+    thumbnail = i["authorThumbnails"][-1]["url"]
+    return ChannelCard(i["authorId"], i["author"], thumbnail if thumbnail.startswith("https") else "https://" + thumbnail)
+
+
+def search(data):
+    return [_search_item(i) for i in loads(data)]
+
+
+def channel(data):
+    """動画一覧が空ならNone(どのインスタンスに聞いても同じなので、そこで打ち切る)。"""
+    t = loads(data)
+    if t["latestVideos"] == []:
+        return None
+    videos = [VideoCard(i["videoId"], i["title"], t["authorId"], t["author"], published=i["publishedText"]) for i in t["latestVideos"]]
+    return Channel(videos, t["author"], t["authorThumbnails"][-1]["url"], t["descriptionHtml"])
+
+
+def playlist(data):
+    return [VideoCard(i["videoId"], i["title"], i["authorId"], i["author"]) for i in loads(data)["videos"]]
+
+
+def comments(data):
+    return [Comment(i["author"], i["authorThumbnails"][-1]["url"], i["authorId"], i["contentHtml"].replace("\n", "<br>")) for i in loads(data)["comments"]]
+
+
+def replies(data):
+    return loads(data)["contentHtml"]
+
+
+# キャッシュ用
+
+def sizeof(value):
+    """レコード(とそのリスト)のおおよそのバイト数。"""
+    if isinstance(value, (str, bytes)):
+        return len(value)
+    if isinstance(value, Record):
+        return sys.getsizeof(value) + sum(sizeof(getattr(value, k)) for k in value.__slots__)
+    if isinstance(value, (list, tuple)):
+        return sys.getsizeof(value) + sum(sizeof(v) for v in value)
+    return sys.getsizeof(value)
+
+
+_classes = {cls.__name__: cls for cls in (VideoCard, PlaylistCard, ChannelCard, Comment, Channel, Video)}
+
+
+def _encode(value):
+    if isinstance(value, Record):
+        return {"@": type(value).__name__, "v": [_encode(getattr(value, k)) for k in value.__slots__]}
+    if isinstance(value, list):
+        return [_encode(v) for v in value]
+    return value
+
+
+def _decode(value):
+    if isinstance(value, dict):
+        cls = _classes[value["@"]]
+        record = cls.__new__(cls)
+        for k, v in zip(cls.__slots__, value["v"]):
+            setattr(record, k, _decode(v))
+        return record
+    if isinstance(value, list):
+        return [_decode(v) for v in value]
+    return value
+
+
+def dumps(value):
+    """ディスクキャッシュに書くためのJSON文字列。"""
+    return json.dumps(_encode(value), ensure_ascii=False)
+
+
+def restore(text):
+    return _decode(loads(text))
@@ -0,0 +1,284 @@
+import asyncio
+import hashlib
+import json
+import mmap
+import os
+import re
+import urllib.parse
+from collections import OrderedDict
+
+import upstream
+
+# /umekomi用のバイト範囲キャッシュ
+# 動画を固定長のセグメントに分けてディスクに保存し、Rangeリクエストのうち
+# キャッシュにある部分はmmapで読み出し、足りないセグメントだけ元サーバーへ取りに行く。
+
+min_chunk = 16 * 1024
+max_chunk = 1024 * 1024
+max_run = 8  # 1回の上流リクエストでまとめて取りに行くセグメント数
+
+
+class OriginError(Exception):
+    def __init__(self, status_code):
+        super().__init__(f"origin returned {status_code}")
+        self.status_code = status_code
+
+
+async def adaptive_chunks(res):
+    """最初は小さく送って再生開始を早め、続くほどチャンクを大きくする。"""
+    size = min_chunk
+    while True:
+        data = await res.aread(size)
+        if not data:
+            break
+        yield data
+        size = min(size * 2, max_chunk)
+
+
+def parse_range(header, total):
+    """Rangeヘッダーから(start, end)を返す。複数範囲など扱えないものはNone、範囲外はValueError。"""
+    m = re.fullmatch(r"\s*bytes=(\d*)-(\d*)\s*", header or "")
+    if m is None:
+        return None
+    first, last = m.groups()
+    if first == "" and last == "":
+        return None
+    if first == "":
+        length = int(last)
+        if length == 0:
+            raise ValueError(header)
+        return max(0, total - length), total - 1
+    start = int(first)
+    end = total - 1 if last == "" else min(int(last), total - 1)
+    if start > end:
+        raise ValueError(header)
+    return start, end
+
+
+class SegmentCache:
+    def __init__(self, directory, max_bytes=1024 * 1024 * 1024, segment_size=1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.segment_size = segment_size
+        self._lru = OrderedDict()  # (key, index) -> size
+        self._meta = {}
+        self._counts = {}  # key -> ディスクにあるセグメント数
+        self._bytes = 0
+        self._counters = {"hit_bytes": 0, "origin_bytes": 0, "evictions": 0, "probes": 0}
+        self._loading = None
+        os.makedirs(directory, exist_ok=True)
+
+    async def _ensure_loaded(self):
+        # 起動を遅くしないよう、ディレクトリの走査は最初に使われたときに別スレッドで行う
+        if self._loading is None:
+            self._loading = asyncio.ensure_future(asyncio.to_thread(self._load))
+        await self._loading
+
+    def _load(self):
+        # 再起動後も前回のセグメントを使えるように、更新時刻の古い順にLRUへ積み直す
+        found = []
+        for key in os.listdir(self.directory):
+            keydir = os.path.join(self.directory, key)
+            try:
+                with open(os.path.join(keydir, "meta.json"), "r", encoding="utf-8") as f:
+                    self._meta[key] = json.load(f)
+                names = os.listdir(keydir)
+            except (OSError, ValueError):
+                continue
+            for name in names:
+                if name.endswith(".seg"):
+                    st = os.stat(os.path.join(keydir, name))
+                    found.append((st.st_mtime, key, int(name[:-4]), st.st_size))
+        for _, key, index, size in sorted(found):
+            self._lru[(key, index)] = size
+            self._counts[key] = self._counts.get(key, 0) + 1
+            self._bytes += size
+        for key in [key for key in self._meta if key not in self._counts]:
+            self._forget(key)
+        self._evict()
+
+    def key_for(self, url):
+        # googlevideoのURLは署名や期限が毎回変わるので、動画IDとitag(と長さ)で同じ中身とみなす。
+        # /umekomiはどこへでも中継するので、他のホストはid・itagが同じでもスキームとホストで分ける
+        # (よそのサーバーが偽の中身を返してgooglevideoの動画のキャッシュに入り込めないように)
+        parts = urllib.parse.urlsplit(url)
+        query = urllib.parse.parse_qs(parts.query)
+        if "id" in query and "itag" in query:
+            ident = "|".join((query["id"][0], query["itag"][0], query.get("clen", [""])[0]))
+            host = (parts.hostname or "").lower()
+            if not host.endswith(".googlevideo.com"):
+                ident = f"{parts.scheme}://{parts.netloc}|{ident}"
+        else:
+            ident = url
+        return hashlib.sha1(ident.encode("utf-8")).hexdigest()
+
+    def _path(self, key, index):
+        return os.path.join(self.directory, key, f"{index}.seg")
+
+    def _has(self, key, index):
+        if (key, index) in self._lru:
+            self._lru.move_to_end((key, index))
+            return True
+        return False
+
+    def _read(self, key, index, lo, hi):
+        try:
+            with open(self._path(key, index), "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                return mm[lo:hi]
+        except (OSError, ValueError):
+            self._drop(key, index)
+            return None
+
+    def _write(self, key, index, data):
+        path = self._path(key, index)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+
+    def _write_meta(self, key, meta):
+        with open(os.path.join(self.directory, key, "meta.json"), "w", encoding="utf-8") as f:
+            json.dump(meta, f)
+
+    async def _add(self, key, meta, index, data):
+        try:
+            await asyncio.to_thread(self._write, key, index, data)
+            if key not in self._meta:
+                # meta.jsonは最初のセグメントと一緒に書き、セグメントの無い動画のものは残さない
+                await asyncio.to_thread(self._write_meta, key, meta)
+                self._meta[key] = meta
+        except OSError:
+            return
+        if (key, index) in self._lru:
+            self._bytes -= self._lru.pop((key, index))
+        else:
+            self._counts[key] = self._counts.get(key, 0) + 1
+        self._lru[(key, index)] = len(data)
+        self._bytes += len(data)
+        self._evict()
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def _drop(self, key, index):
+        size = self._lru.pop((key, index), None)
+        self._remove(self._path(key, index))
+        if size is None:
+            return
+        self._bytes -= size
+        self._counts[key] -= 1
+        if self._counts[key] == 0:
+            # 最後のセグメントと一緒にmeta.jsonとディレクトリも消す
+            self._forget(key)
+
+    def _forget(self, key):
+        self._meta.pop(key, None)
+        self._counts.pop(key, None)
+        self._remove(os.path.join(self.directory, key, "meta.json"))
+        try:
+            os.rmdir(os.path.join(self.directory, key))
+        except OSError:
+            pass
+
+    def _evict(self):
+        while self._lru and self._bytes > self.max_bytes:
+            key, index = next(iter(self._lru))
+            self._drop(key, index)
+            self._counters["evictions"] += 1
+
+    async def _probe(self, url, headers):
+        """先頭1バイトだけ取って全体の長さと種類を知る。Range非対応ならNone。"""
+        self._counters["probes"] += 1
+        res = await upstream.aget(url, stream=True, timeout=30, headers={**headers, "Range": "bytes=0-0"})
+        await res.aclose()
+        if res.status_code >= 400:
+            raise OriginError(res.status_code)
+        m = re.search(r"/(\d+)$", res.headers.get("Content-Range", ""))
+        if res.status_code != 206 or m is None:
+            return None
+        return {"total": int(m.group(1)), "type": res.headers.get("Content-Type", "application/octet-stream")}
+
+    async def open(self, url, range_header, headers):
+        """(ステータス, ヘッダー, 本文のasyncイテレータ)を返す。キャッシュで扱えなければNone。"""
+        await self._ensure_loaded()
+        key = self.key_for(url)
+        meta = self._meta.get(key) or await self._probe(url, headers)
+        if meta is None:
+            return None
+        total = meta["total"]
+        try:
+            span = parse_range(range_header, total) if range_header else (0, total - 1)
+        except ValueError:
+            return 416, {"Content-Range": f"bytes */{total}"}, None
+        if span is None:
+            return None
+        start, end = span
+        out = {"Accept-Ranges": "bytes", "Content-Length": str(end - start + 1), "Content-Type": meta["type"]}
+        if range_header:
+            out["Content-Range"] = f"bytes {start}-{end}/{total}"
+        return (206 if range_header else 200), out, self._body(key, meta, url, headers, start, end)
+
+    async def _body(self, key, meta, url, headers, start, end):
+        total = meta["total"]
+        seg = self.segment_size
+        pos = start
+        chunk = min_chunk
+        while pos <= end:
+            index = pos // seg
+            piece = self._read(key, index, pos - index * seg, end + 1 - index * seg) if self._has(key, index) else None
+            if piece:
+                i = 0
+                while i < len(piece):
+                    yield piece[i:i + chunk]
+                    i += chunk
+                    chunk = min(chunk * 2, max_chunk)
+                self._counters["hit_bytes"] += len(piece)
+                pos += len(piece)
+                continue
+            # 続けて欠けているセグメントをまとめて1回で取りに行く
+            last = index
+            while last + 1 <= end // seg and last - index + 1 < max_run and not self._has(key, last + 1):
+                last += 1
+            fetch_start = index * seg
+            fetch_end = min((last + 1) * seg, total) - 1
+            res = await upstream.aget(url, stream=True, timeout=30, headers={**headers, "Range": f"bytes={fetch_start}-{fetch_end}"})
+            if res.status_code != 206:
+                await res.aclose()
+                return
+            offset = fetch_start
+            buf = bytearray()
+            seg_index = index
+            try:
+                while offset <= fetch_end:
+                    data = await res.aread(chunk)
+                    if not data:
+                        break
+                    data_start = offset
+                    offset += len(data)
+                    lo, hi = max(pos, data_start), min(end + 1, offset)
+                    if lo < hi:
+                        yield data[lo - data_start:hi - data_start]
+                        pos = hi
+                    self._counters["origin_bytes"] += len(data)
+                    buf += data
+                    while len(buf) >= seg or (offset > fetch_end and buf):
+                        await self._add(key, meta, seg_index, bytes(buf[:seg]))
+                        del buf[:seg]
+                        seg_index += 1
+                    chunk = min(chunk * 2, max_chunk)
+            finally:
+                await res.aclose()
+            if offset <= fetch_end:
+                # 上流が途中で切れた
+                return
+
+    def stats(self):
+        stats = dict(self._counters)
+        stats["segments"] = len(self._lru)
+        stats["bytes"] = self._bytes
+        stats["max_bytes"] = self.max_bytes
+        return stats
@@ -0,0 +1,187 @@
+import json
+import os
+import sqlite3
+import time
+from contextlib import contextmanager
+from threading import RLock, local
+
+# ワーカープロセス間で共有する状態(SQLiteのWALモード)
+# uvicornを--workersで複数起動しても、同じファイルを通して全プロセスが
+# 設定(掲示板のURL・API一覧)、インスタンスの健康状態、レスポンスキャッシュの2段目を使う。
+# WALなので読むだけなら書き込み中でも待たない。書き込みは短いトランザクションで順番に行う。
+# pathが":memory:"ならこのプロセスだけのもの(persistent=False)。
+# 接続はプロセスごとに1本で、スレッド間ではロックで順番に使う。fork後に使われたら繋ぎ直す。
+# キャッシュの2段目(SharedCacheTier)だけはスレッドごとに別の接続を持ち、このロックを使わない。
+
+errors = (sqlite3.Error,)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS config (key TEXT PRIMARY KEY, value TEXT NOT NULL, updated REAL NOT NULL);
+CREATE TABLE IF NOT EXISTS health (kind TEXT NOT NULL, api TEXT NOT NULL, latency REAL NOT NULL, success_rate REAL NOT NULL, successes INTEGER NOT NULL, failures INTEGER NOT NULL, updated REAL NOT NULL, PRIMARY KEY (kind, api));
+CREATE TABLE IF NOT EXISTS circuits (api TEXT PRIMARY KEY, consecutive_failures INTEGER NOT NULL, opened_until REAL NOT NULL, trips INTEGER NOT NULL, probe_until REAL NOT NULL, updated REAL NOT NULL);
+CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires REAL NOT NULL, stale_until REAL NOT NULL, size INTEGER NOT NULL, stored REAL NOT NULL);
+CREATE INDEX IF NOT EXISTS cache_stored ON cache (stored);
+"""
+
+
+class SharedState:
+    def __init__(self, path, timeout=5.0):
+        self.path = path
+        self.timeout = timeout
+        self.persistent = path != ":memory:"
+        self._lock = RLock()
+        self._db = None
+        self._pid = None
+        self._connect()
+
+    def _connect(self):
+        if self.persistent:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        db = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None, check_same_thread=False)
+        if self.persistent:
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+        db.executescript(SCHEMA)
+        self._db, self._pid = db, os.getpid()
+
+    def _conn(self):
+        # ロックを持った状態で呼ぶ
+        if self.persistent and self._pid != os.getpid():
+            self._connect()
+        return self._db
+
+    @contextmanager
+    def transaction(self):
+        """書き込みトランザクション。中から他のメソッドを呼ぶとその中で実行される。"""
+        with self._lock:
+            db = self._conn()
+            if db.in_transaction:
+                yield db
+                return
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                yield db
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+            db.execute("COMMIT")
+
+    def _execute(self, sql, params=()):
+        with self._lock:
+            return self._conn().execute(sql, params).fetchall()
+
+    def get_config(self, key, default=None, max_age=None):
+        """設定値。無いか、max_age秒より前に書かれたものならdefault。"""
+        rows = self._execute("SELECT value, updated FROM config WHERE key = ?", (key,))
+        if not rows or (max_age is not None and time.time() - rows[0][1] > max_age):
+            return default
+        return json.loads(rows[0][0])
+
+    def set_config(self, key, value):
+        self._execute("INSERT OR REPLACE INTO config VALUES (?, ?, ?)", (key, json.dumps(value), time.time()))
+
+    def read_health(self, max_age=None):
+        """(kind, api, latency, success_rate, successes, failures)と(api, consecutive_failures, opened_until, trips, probe_until)の行。"""
+        since = time.time() - max_age if max_age is not None else 0
+        with self._lock:
+            db = self._conn()
+            stats = db.execute("SELECT kind, api, latency, success_rate, successes, failures FROM health WHERE updated >= ?", (since,)).fetchall()
+            circuits = db.execute("SELECT api, consecutive_failures, opened_until, trips, probe_until FROM circuits WHERE updated >= ?", (since,)).fetchall()
+        return stats, circuits
+
+    def write_health(self, stats, circuits):
+        now = time.time()
+        with self.transaction() as db:
+            db.executemany("INSERT OR REPLACE INTO health VALUES (?, ?, ?, ?, ?, ?, ?)", [tuple(row) + (now,) for row in stats])
+            db.executemany("INSERT OR REPLACE INTO circuits VALUES (?, ?, ?, ?, ?, ?)", [tuple(row) + (now,) for row in circuits])
+
+    def stats(self):
+        with self._lock:
+            entries, size = self._conn().execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM cache").fetchone()
+        try:
+            file_bytes = os.path.getsize(self.path) if self.persistent else 0
+        except OSError:
+            file_bytes = 0
+        return {"cache_entries": entries, "cache_bytes": size, "file_bytes": file_bytes}
+
+
+class SharedCacheTier:
+    """DiskTierと同じ使い方で、SharedStateのcacheテーブルに置くキャッシュの2段目。
+
+    TTLCacheから別スレッドで呼ばれる前提で、接続はスレッドごとに持つ。健康状態の同期が
+    書き込みを待っていても、キャッシュの読み出しはSharedStateのロックで待たされない。
+    容量を超えた分はprune()で消す。set()からは呼ばないので、裏の定期処理から呼ぶ。"""
+
+    def __init__(self, state, max_bytes=256 * 1024 * 1024, encode=None, decode=None):
+        self.path = state.path
+        self.timeout = state.timeout
+        self.max_bytes = max_bytes
+        self.encode = encode
+        self.decode = decode
+        self._written = 0
+        self._local = local()
+
+    def _conn(self):
+        conn = self._local
+        if getattr(conn, "pid", None) != os.getpid():
+            conn.db = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None, check_same_thread=False)
+            conn.db.execute("PRAGMA synchronous=NORMAL")
+            conn.pid = os.getpid()
+        return conn.db
+
+    def get(self, key):
+        try:
+            rows = self._conn().execute("SELECT value, expires, stale_until FROM cache WHERE key = ? AND stale_until > ?", (str(key), time.time())).fetchall()
+            if not rows:
+                return None
+            value, expires, stale_until = rows[0]
+            if self.decode is not None:
+                value = self.decode(value)
+            return value, expires, stale_until
+        except (*errors, ValueError, KeyError):
+            return None
+
+    def set(self, key, value, expires, stale_until):
+        if self.encode is not None:
+            value = self.encode(value)
+        if not isinstance(value, str):
+            return
+        try:
+            self._conn().execute("INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?, ?, ?)", (str(key), value, expires, stale_until, len(value), time.time()))
+        except errors:
+            return
+        self._written += len(value)
+
+    def delete(self, key):
+        try:
+            self._conn().execute("DELETE FROM cache WHERE key = ?", (str(key),))
+        except errors:
+            pass
+
+    def prune(self, force=False):
+        """期限切れを消し、それでもmax_bytesを超えていれば古く書かれたものから消す。
+
+        forceでなければ、前回からmax_bytesの1/8以上書き込んだときだけ行う。"""
+        if not force and self._written <= self.max_bytes // 8:
+            return
+        self._written = 0
+        try:
+            db = self._conn()
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                db.execute("DELETE FROM cache WHERE stale_until <= ?", (time.time(),))
+                total = db.execute("SELECT COALESCE(SUM(size), 0) FROM cache").fetchone()[0]
+                doomed = []
+                if total > self.max_bytes:
+                    for key, size in db.execute("SELECT key, size FROM cache ORDER BY stored"):
+                        if total <= self.max_bytes:
+                            break
+                        doomed.append((key,))
+                        total -= size
+                db.executemany("DELETE FROM cache WHERE key = ?", doomed)
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+            db.execute("COMMIT")
+        except errors:
+            pass
@@ -0,0 +1,112 @@
+import asyncio
+import json
+import unicodedata
+from collections import Counter
+
+import logs
+from cache import TTLCache
+
+# /suggestの検索候補キャッシュ
+# 入力中の文字列(プレフィックス)ごとに候補をTTL付きで持ち、同じプレフィックスの同時リクエストは1回の取得にまとめる。
+# 短いプレフィックスの候補が上限(limit)に届かず、しかもどれもそのプレフィックスで始まっていれば
+# 候補が出尽くしているとみなし、長いプレフィックスはその中から前方一致で絞り込んで上流へは行かない。
+# (日本語では「あら」→「嵐」のように入力で始まらない候補が返るので、そういうものが混ざれば絞り込まない)
+# よく打たれるプレフィックスは裏で期限が切れる前に取り直しておく。
+
+
+def normalize(keyword):
+    # 全角・半角や大文字小文字の違いは同じ入力とみなす。末尾の空白は次の単語の候補になるので残す
+    return unicodedata.normalize("NFKC", keyword).lower().lstrip()
+
+
+def parse_jsonp(text):
+    """window.google.ac.h([...]) の形から候補の文字列のリストを取り出す。"""
+    data = json.loads(text[text.index("(") + 1:text.rindex(")")])
+    return [i[0] for i in data[1]]
+
+
+class SuggestionCache:
+    def __init__(self, fetch, ttl=600, stale=3600, max_entries=8192, limit=10, hot_size=100, precompute_interval=300, precompute_concurrency=4):
+        self.fetch = fetch  # fetch(keyword) -> 候補のリスト
+        self.limit = limit
+        self.hot_size = hot_size
+        self.precompute_interval = precompute_interval
+        self.precompute_concurrency = precompute_concurrency
+        self._cache = TTLCache(ttl, max_entries=max_entries, stale=stale)
+        self._popular = Counter()
+        self._counters = {"requests": 0, "prefix_reuse": 0, "precomputed": 0}
+
+    async def _load(self, key):
+        suggestions = await self.fetch(key)
+        complete = len(suggestions) < self.limit and all(normalize(s).startswith(key) for s in suggestions)
+        return suggestions, complete
+
+    def _from_shorter(self, key):
+        # 一番長い、出尽くしている短いプレフィックスの候補から絞り込む
+        for end in range(len(key) - 1, 0, -1):
+            cached = self._cache.get(key[:end])
+            if cached is not None:
+                suggestions, complete = cached
+                if not complete:
+                    return None
+                return [s for s in suggestions if normalize(s).startswith(key)]
+        return None
+
+    async def get(self, keyword):
+        key = normalize(keyword)
+        self._counters["requests"] += 1
+        if self.hot_size > 0:
+            self._popular[key] += 1
+            if len(self._popular) > self.hot_size * 10:
+                self._trim_popular()
+        if not key.strip():
+            return []
+        cached = self._cache.get(key)
+        if cached is None:
+            narrowed = self._from_shorter(key)
+            if narrowed is not None:
+                self._counters["prefix_reuse"] += 1
+                return narrowed
+        suggestions, _ = await self._cache.aget_or_load(key, lambda: self._load(key))
+        return suggestions
+
+    def _trim_popular(self):
+        # 次の集計を待たずに増えすぎたら、1回しか打たれていない途中の入力から捨てる。
+        # それでも多ければ上位だけ残す
+        popular = Counter({key: count for key, count in self._popular.items() if count > 1})
+        if len(popular) > self.hot_size * 5:
+            popular = Counter(dict(popular.most_common(self.hot_size * 5)))
+        self._popular = popular
+
+    async def precompute(self):
+        """よく打たれたプレフィックスを取り直す。回数は次の集計に向けて半分にする。"""
+        # 短いプレフィックスから絞り込めるものは取り直さない
+        hot = [key for key, _ in self._popular.most_common(self.hot_size) if key.strip() and self._from_shorter(key) is None]
+        self._popular = Counter({key: count // 2 for key, count in self._popular.most_common(self.hot_size * 10) if count // 2})
+        slots = asyncio.Semaphore(self.precompute_concurrency)
+
+        async def refresh(key):
+            async with slots:
+                try:
+                    self._cache.set(key, await self._load(key))
+                    self._counters["precomputed"] += 1
+                except Exception as e:
+                    logs.debug("検索候補の事前取得に失敗しました", keyword=key, error=type(e).__name__)
+
+        await asyncio.gather(*[refresh(key) for key in hot])
+
+    async def run_precompute(self):
+        while True:
+            await asyncio.sleep(self.precompute_interval)
+            await self.precompute()
+
+    def stats(self):
+        stats = dict(self._counters)
+        cached = self._cache.stats()
+        for key in ("hits", "stale_hits", "misses", "coalesced", "entries"):
+            stats[key] = cached[key]
+        upstream = cached["misses"] + cached["refreshes"] + stats["precomputed"]
+        stats["upstream"] = upstream
+        # 同じ取得を待っただけのリクエスト(coalesced)も上流の応答を待っているので当たりには数えない
+        stats["hit_rate"] = 1 - (cached["misses"] + cached["coalesced"]) / stats["requests"] if stats["requests"] else 0.0
+        return stats
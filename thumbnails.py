@@ -0,0 +1,182 @@
+import asyncio
+import email.utils
+import hashlib
+import json
+import os
+import re
+import time
+from collections import OrderedDict
+
+import upstream
+from cache import prune_directory
+
+# サムネイルのキャッシュ
+# メモリとディスクの2段で持ち、古くなったものは元サーバーへ条件付きリクエストで確認し直す。
+# ブラウザにはETag/Last-Modified/Cache-Controlを付けて返し、変わっていなければ304にする。
+
+video_id_pattern = re.compile(r"[A-Za-z0-9_-]{1,64}")
+
+
+class Thumbnail:
+    __slots__ = ("body", "etag", "origin_etag", "last_modified", "content_type", "checked")
+
+    def __init__(self, body, origin_etag, last_modified, content_type, checked):
+        self.body = body
+        self.etag = '"' + hashlib.sha1(body).hexdigest() + '"'
+        self.origin_etag = origin_etag
+        self.last_modified = last_modified
+        self.content_type = content_type
+        self.checked = checked
+
+
+class ThumbnailStore:
+    def __init__(self, directory, memory_bytes=32 * 1024 * 1024, disk_bytes=512 * 1024 * 1024, fresh_seconds=86400, max_age=86400,
+                 origin="https://img.youtube.com/vi/{v}/0.jpg", prefetch_concurrency=8):
+        self.directory = directory
+        self.memory_bytes = memory_bytes
+        self.disk_bytes = disk_bytes
+        self.fresh_seconds = fresh_seconds
+        self.max_age = max_age
+        self.origin = origin
+        self.prefetch_concurrency = prefetch_concurrency
+        self._memory = OrderedDict()
+        self._memory_size = 0
+        self._disk_written = 0
+        self._flights = {}
+        self._prefetch_slots = None
+        self._prefetches = set()  # 取りに行っている途中で消されないよう持っておく
+        self._counters = dict.fromkeys(("memory_hits", "disk_hits", "misses", "revalidated", "not_modified", "prefetched", "errors"), 0)
+        os.makedirs(directory, exist_ok=True)
+
+    def valid_id(self, v):
+        return video_id_pattern.fullmatch(v) is not None
+
+    def _remember(self, v, thumb):
+        old = self._memory.pop(v, None)
+        if old is not None:
+            self._memory_size -= len(old.body)
+        self._memory[v] = thumb
+        self._memory_size += len(thumb.body)
+        while self._memory and self._memory_size > self.memory_bytes:
+            _, dropped = self._memory.popitem(last=False)
+            self._memory_size -= len(dropped.body)
+
+    def _load_disk(self, v):
+        try:
+            with open(os.path.join(self.directory, v + ".json"), "r", encoding="utf-8") as f:
+                meta = json.load(f)
+            with open(os.path.join(self.directory, v + ".jpg"), "rb") as f:
+                body = f.read()
+        except (OSError, ValueError):
+            return None
+        return Thumbnail(body, meta.get("etag"), meta.get("last_modified"), meta.get("content_type", "image/jpeg"), meta.get("checked", 0))
+
+    def _save_disk(self, v, thumb):
+        base = os.path.join(self.directory, v)
+        try:
+            with open(base + ".jpg.tmp", "wb") as f:
+                f.write(thumb.body)
+            os.replace(base + ".jpg.tmp", base + ".jpg")
+            with open(base + ".json.tmp", "w", encoding="utf-8") as f:
+                json.dump({"etag": thumb.origin_etag, "last_modified": thumb.last_modified, "content_type": thumb.content_type, "checked": thumb.checked}, f)
+            os.replace(base + ".json.tmp", base + ".json")
+        except OSError:
+            return
+        self._disk_written += len(thumb.body)
+        if self._disk_written > self.disk_bytes // 8:
+            self._disk_written = 0
+            prune_directory(self.directory, self.disk_bytes)
+
+    async def _fetch(self, v, cached):
+        headers = {}
+        if cached is not None:
+            if cached.origin_etag:
+                headers["If-None-Match"] = cached.origin_etag
+            if cached.last_modified:
+                headers["If-Modified-Since"] = cached.last_modified
+        res = await upstream.aget(self.origin.format(v=v), timeout=10, headers=headers)
+        if res.status_code == 304 and cached is not None:
+            self._counters["not_modified"] += 1
+            cached.checked = time.time()
+            thumb = cached
+        elif res.status_code == 200:
+            thumb = Thumbnail(res.content, res.headers.get("ETag"), res.headers.get("Last-Modified"), res.headers.get("Content-Type", "image/jpeg"), time.time())
+        else:
+            raise upstream.UpstreamStatusError(res.status_code)
+        self._remember(v, thumb)
+        await asyncio.to_thread(self._save_disk, v, thumb)
+        return thumb
+
+    async def get(self, v):
+        """サムネイルを返す。同じ動画への同時リクエストは1回の取得にまとめる。"""
+        thumb = self._memory.get(v)
+        if thumb is not None:
+            self._memory.move_to_end(v)
+            self._counters["memory_hits"] += 1
+        else:
+            thumb = await asyncio.to_thread(self._load_disk, v)
+            if thumb is not None:
+                self._counters["disk_hits"] += 1
+                self._remember(v, thumb)
+        if thumb is not None and time.time() - thumb.checked < self.fresh_seconds:
+            return thumb
+        flight = self._flights.get(v)
+        if flight is None:
+            if thumb is None:
+                self._counters["misses"] += 1
+            else:
+                self._counters["revalidated"] += 1
+            flight = self._flights[v] = asyncio.ensure_future(self._fetch(v, thumb))
+            flight.add_done_callback(lambda _: self._flights.pop(v, None))
+        try:
+            return await asyncio.shield(flight)
+        except Exception:
+            self._counters["errors"] += 1
+            if thumb is not None:
+                # 確認できなくても手元のものを返す
+                return thumb
+            raise
+
+    def headers(self, thumb):
+        headers = {"ETag": thumb.etag, "Cache-Control": f"public, max-age={self.max_age}"}
+        if thumb.last_modified:
+            headers["Last-Modified"] = thumb.last_modified
+        return headers
+
+    def not_modified(self, thumb, request_headers):
+        """ブラウザの条件付きリクエストに304で答えてよいか。"""
+        if_none_match = request_headers.get("if-none-match")
+        if if_none_match is not None:
+            return thumb.etag in [tag.strip() for tag in if_none_match.split(",")] or if_none_match.strip() == "*"
+        since = request_headers.get("if-modified-since")
+        if since and thumb.last_modified:
+            try:
+                return email.utils.parsedate_to_datetime(thumb.last_modified) <= email.utils.parsedate_to_datetime(since)
+            except (TypeError, ValueError):
+                return False
+        return False
+
+    def prefetch(self, ids):
+        """検索結果などのサムネイルを裏で温めておく。同時に取りに行く数は prefetch_concurrency まで。"""
+        if self._prefetch_slots is None:
+            self._prefetch_slots = asyncio.Semaphore(self.prefetch_concurrency)
+
+        async def warm(v):
+            async with self._prefetch_slots:
+                try:
+                    await self.get(v)
+                    self._counters["prefetched"] += 1
+                except Exception:
+                    pass
+
+        for v in dict.fromkeys(ids):
+            if v and self.valid_id(v) and v not in self._memory and v not in self._flights:
+                task = asyncio.ensure_future(warm(v))
+                self._prefetches.add(task)
+                task.add_done_callback(self._prefetches.discard)
+
+    def stats(self):
+        stats = dict(self._counters)
+        stats["memory_entries"] = len(self._memory)
+        stats["memory_bytes"] = self._memory_size
+        return stats
@@ -0,0 +1,141 @@
+import asyncio
+import os
+import time
+import urllib.parse
+import weakref
+from threading import Lock
+
+import aiohttp
+
+# 上流(Invidious, Google, img.youtube.com, 掲示板サーバーなど)への共有HTTPクライアント
+# ホストごとにkeep-aliveのコネクションプールを持ち、毎回のTCP/TLSハンドシェイクを省く。
+
+connect_retries = int(os.environ.get("YUKI_CONNECT_RETRIES", "1"))  # 接続失敗時の再試行回数
+async_pool_size = int(os.environ.get("YUKI_ASYNC_POOL_SIZE", "256"))  # ホストごとに同時に張るコネクション数
+
+# 非同期版のリクエストが失敗したときに送出される例外
+async_errors = (aiohttp.ClientError, asyncio.TimeoutError)
+# タイムアウトとみなす例外
+timeout_errors = (asyncio.TimeoutError,)
+
+
+class UpstreamStatusError(Exception):
+    """上流がエラーのステータスを返した。"""
+
+    def __init__(self, status_code):
+        super().__init__(f"upstream returned {status_code}")
+        self.status_code = status_code
+
+
+class AsyncResponse:
+    """非同期クライアントの応答。本文を読み終えたものはtext/contentで、ストリームはaiter_rawで読む。"""
+
+    def __init__(self, raw, content=None):
+        self.raw = raw
+        self.status_code = raw.status
+        self.headers = raw.headers
+        self.content = content
+
+    @property
+    def text(self):
+        return self.content.decode(self.raw.get_encoding() if self.content else "utf-8", errors="replace")
+
+    def aiter_raw(self, chunk_size=8192):
+        return self.raw.content.iter_chunked(chunk_size)
+
+    async def aread(self, n):
+        """ストリームから最大nバイト読む。終わりなら空のbytes。"""
+        return await self.raw.content.read(n)
+
+    async def aclose(self):
+        self.raw.release()
+
+
+class AsyncUpstreamClient:
+    """上流へのHTTPクライアント。待ち時間中にワーカーのスレッドを占有しない。"""
+
+    def __init__(self, pool_size=async_pool_size, connect_retries=connect_retries):
+        self.pool_size = pool_size
+        self.connect_retries = connect_retries
+        self._sessions = weakref.WeakKeyDictionary()
+        self._lock = Lock()
+        self._hosts = {}
+
+    def _session(self):
+        # aiohttpのセッションはイベントループに紐づくのでループごとに作る
+        loop = asyncio.get_running_loop()
+        session = self._sessions.get(loop)
+        if session is None or session.closed:
+            connector = aiohttp.TCPConnector(limit=0, limit_per_host=self.pool_size, keepalive_timeout=30, ttl_dns_cache=300)
+            # 利用者ごとのCookieが混ざらないようにレスポンスのCookieは保存しない
+            session = self._sessions[loop] = aiohttp.ClientSession(connector=connector, cookie_jar=aiohttp.DummyCookieJar())
+        return session
+
+    def _count(self, host, key, value=1):
+        with self._lock:
+            counters = self._hosts.get(host)
+            if counters is None:
+                counters = self._hosts[host] = {"requests": 0, "errors": 0, "seconds": 0.0}
+            counters[key] += value
+
+    async def get(self, url, timeout=None, stream=False, headers=None, allow_redirects=True):
+        host = urllib.parse.urlsplit(url).netloc
+        self._count(host, "requests")
+        start = time.time()
+        headers = dict(headers or {})
+        if stream:
+            # 中継するときは圧縮されたまま流すのでContent-Lengthと中身がずれないようにする
+            headers.setdefault("Accept-Encoding", "identity")
+            client_timeout = aiohttp.ClientTimeout(total=None, sock_connect=timeout, sock_read=timeout)
+        else:
+            client_timeout = aiohttp.ClientTimeout(total=timeout)
+        try:
+            for attempt in range(self.connect_retries + 1):
+                try:
+                    raw = await self._session().get(url, headers=headers, timeout=client_timeout, allow_redirects=allow_redirects, auto_decompress=not stream)
+                    break
+                except aiohttp.ClientConnectorError:
+                    if attempt >= self.connect_retries:
+                        raise
+                    await asyncio.sleep(0.05 * (attempt + 1))
+            if stream:
+                return AsyncResponse(raw)
+            try:
+                return AsyncResponse(raw, await raw.read())
+            finally:
+                raw.release()
+        except async_errors:
+            self._count(host, "errors")
+            raise
+        finally:
+            self._count(host, "seconds", time.time() - start)
+
+    async def aclose(self):
+        session = self._sessions.pop(asyncio.get_running_loop(), None)
+        if session is not None:
+            await session.close()
+
+    def stats(self):
+        with self._lock:
+            hosts = {host: dict(counters) for host, counters in self._hosts.items()}
+        for session in list(self._sessions.values()):
+            connector = session.connector
+            if connector is None:
+                continue
+            for key, conns in list(getattr(connector, "_conns", {}).items()):
+                host = key.host if key.port in (None, 80, 443) else f"{key.host}:{key.port}"
+                row = hosts.setdefault(host, {"requests": 0, "errors": 0, "seconds": 0.0})
+                row["idle_connections"] = row.get("idle_connections", 0) + len(conns)
+                row["pool_size"] = self.pool_size
+            for key, acquired in list(getattr(connector, "_acquired_per_host", {}).items()):
+                host = key.host if key.port in (None, 80, 443) else f"{key.host}:{key.port}"
+                row = hosts.setdefault(host, {"requests": 0, "errors": 0, "seconds": 0.0})
+                row["active_connections"] = row.get("active_connections", 0) + len(acquired)
+                row["pool_size"] = self.pool_size
+        return hosts
+
+
+async_client = AsyncUpstreamClient()
+aget = async_client.get
+aclose = async_client.aclose
+stats = async_client.stats
@@ -0,0 +1,72 @@
+import asyncio
+import os
+import signal
+
+import logs
+from cache import TTLCache
+
+# 掲示板に書き込むときのserververify(yukiverifyの出力)を用意する
+# 出力はvalidity秒のあいだ使い回し、同時に必要になったときも起動は1回にまとめる。
+# 起動したプロセスはtimeout秒で打ち切り、失敗したら(異常終了・空の出力・タイムアウト)retries回までやり直す。
+# 同時に動かすプロセスはmax_concurrencyまで。
+
+
+class VerifierError(Exception):
+    pass
+
+
+class VerifyCodeProvider:
+    def __init__(self, command=("./yukiverify",), validity=10, timeout=5, retries=1, max_concurrency=2):
+        self.command = list(command)
+        self.timeout = timeout
+        self.retries = retries
+        self.max_concurrency = max_concurrency
+        self._codes = TTLCache(validity, max_entries=1)
+        self._slots = None
+        self._counters = {"runs": 0, "failures": 0, "timeouts": 0}
+
+    async def _run_once(self):
+        self._counters["runs"] += 1
+        # 打ち切るときに子プロセスごと止められるよう、別のプロセスグループで起動する
+        proc = await asyncio.create_subprocess_exec(*self.command, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL, start_new_session=True)
+        try:
+            out, _ = await asyncio.wait_for(proc.communicate(), self.timeout)
+        except asyncio.TimeoutError:
+            self._counters["timeouts"] += 1
+            try:
+                os.killpg(proc.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+            await proc.wait()
+            raise VerifierError(f"{self.command[0]} timed out after {self.timeout}s")
+        code = out.decode("utf-8", errors="replace").strip()
+        if proc.returncode != 0 or not code:
+            raise VerifierError(f"{self.command[0]} exited with {proc.returncode}")
+        return code
+
+    async def _run(self):
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_concurrency)
+        async with self._slots:
+            for attempt in range(self.retries + 1):
+                try:
+                    return await self._run_once()
+                except (OSError, VerifierError) as e:
+                    self._counters["failures"] += 1
+                    logs.warning("yukiverifyの実行に失敗しました", error=str(e), attempt=attempt + 1)
+                    if attempt >= self.retries:
+                        raise
+
+    async def get(self):
+        """使えるserververifyを返す。用意できなければNone。"""
+        try:
+            return await self._codes.aget_or_load("code", self._run)
+        except (OSError, VerifierError):
+            return None
+
+    def stats(self):
+        stats = dict(self._counters)
+        cached = self._codes.stats()
+        stats["hits"] = cached["hits"]
+        stats["coalesced"] = cached["coalesced"]
+        return stats